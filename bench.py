@@ -0,0 +1,342 @@
+# benchmarks of the hot paths: snapshot serialization, collision, lasers,
+# wave spawning and whole ticks at level 1, 20 and 50 wave sizes, and with
+# --net full matches over loopback with 2, 200 and 2000 connections. the
+# results go to a json file, and --compare fails (exit 1) when anything got
+# slower than the stored baseline by more than its tolerance:
+#
+#   python bench.py --save-baseline     # on the reference machine, once
+#   python bench.py --compare           # after a change
+#   python bench.py --net --only net_200
+#
+# timings are per call, the best of a few repeats; numbers are only
+# comparable on the same machine
+
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+import snapshots
+from collision import collide
+from protocol import (encode_json, INPUT_READY, INPUT_FIRE, INPUT_LEFT,
+                      INPUT_RIGHT)
+from simulation import Simulation, Laser, Enemy, SPRITES, LASERS
+
+try:
+    from entity_arrays import ArraySimulation
+except ImportError:  # numpy is optional
+    ArraySimulation = None
+
+RESULTS = 'bench-results.json'
+BASELINE = 'bench-baseline.json'
+REPEAT = 5
+# how much slower than the baseline a result may get before --compare fails
+TOLERANCE = 0.2
+NET_TOLERANCE = 0.5
+LEVELS = (1, 20, 50)
+NET_SIZES = (2, 200, 2000)
+NET_DURATION = 5
+NET_PORT = 5150
+SEED = 1
+# substring of the benchmarks to run, --only
+only = None
+# TOLERANCE, or what --tolerance says
+max_slowdown = TOLERANCE
+
+
+def selected(name):
+    return only is None or only in name
+
+
+def measure(results, name, setup, number, repeat=REPEAT):
+    if selected(name):
+        results[name] = timed(setup, number, repeat)
+
+
+def timed(setup, number, repeat=REPEAT):
+    # seconds per call of the function setup() returns, best of repeat runs
+    # of number calls. setup runs again before every run, untimed
+    best = None
+    for run in range(repeat):
+        func = setup()
+        started = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = (time.perf_counter() - started) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def playing(level, simulation_class=Simulation):
+    # a two player match at the start of the given level's wave, both
+    # players ready, firing and unable to die
+    simulation = simulation_class(60, SEED)
+    for slot in (1, 2):
+        simulation.submit('join', slot, ('bench', slot))
+        simulation.submit('input', slot, INPUT_READY, simulation.tick + 1)
+    simulation.step()
+    for player in simulation.players.values():
+        player.health = 10**9
+    simulation.clear_enemies()
+    simulation.level = level - 1
+    simulation.wave_length = 10 * level
+    simulation.spawn_wave()
+    return simulation
+
+
+def play(simulation, ticks):
+    # one input per player and tick, numbered the way a client numbers them
+    for i in range(ticks):
+        move = INPUT_LEFT if (simulation.tick // 30) % 2 else INPUT_RIGHT
+        for slot in (1, 2):
+            simulation.submit('input', slot, INPUT_READY | INPUT_FIRE | move,
+                              simulation.tick + 1)
+        simulation.step()
+
+
+def in_view(simulation, rng):
+    # the whole wave on screen, where it collides
+    for enemy in simulation.enemies:
+        enemy.y = rng.randrange(0, 600)
+
+
+def micro_benchmarks(results, levels):
+    rng = random.Random(SEED)
+    laser = Laser(100, 100, SPRITES['laser_yellow'])
+    enemy = Enemy(90, 80, 'red')
+    measure(results, 'collide_pair', lambda: lambda: collide(laser, enemy),
+            100000)
+    for level in levels:
+        simulation = playing(level)
+        in_view(simulation, rng)
+        play(simulation, 2)
+        before = simulation.history[simulation.tick - 1]
+        after = simulation.state
+        change = snapshots.delta(before, after)
+        keyframe = snapshots.delta(snapshots.new_state(), after)
+        measure(results, f'delta_l{level}',
+                lambda: lambda: snapshots.delta(before, after), 200)
+        measure(results, f'encode_delta_l{level}',
+                lambda: lambda: encode_json(change), 200)
+        measure(results, f'encode_keyframe_l{level}',
+                lambda: lambda: encode_json(keyframe), 200)
+        measure(results, f'apply_delta_l{level}',
+                lambda: lambda: snapshots.apply(snapshots.copy_state(before),
+                                                change), 200)
+
+        def collisions():
+            # every laser and player against the indexed wave
+            simulation.index_enemies()
+            for player in simulation.players.values():
+                simulation.enemy_hits(player)
+                for shot in player.lasers:
+                    simulation.enemy_hits(shot)
+
+        measure(results, f'collisions_l{level}', lambda: collisions, 100)
+
+        def lasers_setup():
+            # 40 lasers per player spread over the screen, as after holding
+            # fire for a while
+            for player in simulation.players.values():
+                LASERS.release_all(player.lasers)
+                player.lasers = [
+                    LASERS.acquire(player.x, y, player.laser_sprite)
+                    for y in range(10, 610, 15)
+                ]
+            in_view(simulation, rng)
+            return simulation.resolve_collisions
+
+        measure(results, f'move_lasers_l{level}', lasers_setup, 1, 50)
+
+        def spawn():
+            simulation.clear_enemies()
+            simulation.level = level - 1
+            simulation.wave_length = 10 * level
+            simulation.spawn_wave()
+
+        measure(results, f'spawn_wave_l{level}', lambda: spawn, 20)
+
+
+def tick_benchmarks(results, levels):
+    classes = [('', Simulation)]
+    if ArraySimulation is not None:
+        classes.append(('_arrays', ArraySimulation))
+    for level in levels:
+        for suffix, simulation_class in classes:
+
+            def setup():
+                # into the wave far enough that it is on screen, and one
+                # snapshot per tick as a room with players sends
+                simulation = playing(level, simulation_class)
+                simulation.listeners.append(
+                    lambda simulation: simulation.snapshot_frame(
+                        simulation.tick - 1))
+                play(simulation, 400)
+                return lambda: play(simulation, 1)
+
+            measure(results, f'tick_l{level}{suffix}', setup, 200, 3)
+
+
+def net_benchmark(results, size, duration):
+    # a server of our own, size bots against it, and what the bots and the
+    # server's stats say
+    import loadtest
+    # two bots per room, all of them seated: bots in the lobby never start
+    server = subprocess.Popen(
+        [sys.executable, 'server.py', '--port', str(NET_PORT),
+         '--max-rooms', str(size // 2 + 1)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    addr = (loadtest.SERVER, NET_PORT)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(addr, timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        processes = max(1, min(multiprocessing.cpu_count(), size // 500))
+        shares = [size // processes + (i < size % processes)
+                  for i in range(processes)]
+        with multiprocessing.Pool(processes) as pool:
+            pending = pool.starmap_async(
+                loadtest.run_process,
+                [(addr, count, 'random', duration, SEED + i)
+                 for i, count in enumerate(shares)])
+            polls = []
+            while not pending.ready():
+                pending.wait(loadtest.STATS_INTERVAL)
+                try:
+                    stats = loadtest.server_stats(addr)
+                except (OSError, ValueError):
+                    continue
+                if stats['ticks']:
+                    polls.append(stats)
+            runs = pending.get()
+    finally:
+        server.kill()
+        server.wait()
+    seconds = max(run['seconds'] for run in runs)
+    latencies = sorted(latency for run in runs
+                       for latency in run['latencies'])
+    name = f'net_{size}'
+    results[f'{name}.latency_p50'] = loadtest.percentile(latencies, 0.5)
+    results[f'{name}.latency_p99'] = loadtest.percentile(latencies, 0.99)
+    results[f'{name}.bytes_per_bot'] = sum(
+        run['bytes_in'] for run in runs) / seconds / size
+    if polls:
+        results[f'{name}.tick_p99'] = max(poll['tick_p99'] for poll in polls)
+
+
+def tolerance(name):
+    return NET_TOLERANCE if name.startswith('net_') else max_slowdown
+
+
+def shown(name, value):
+    # microseconds, or bytes for bytes_per_bot
+    if name.endswith('bytes_per_bot'):
+        return f"{value:12.0f}"
+    return f"{value * 1e6:12.1f}"
+
+
+def compare(results, baseline):
+    # names of results slower than the baseline by more than they may be
+    slower = []
+    for name, value in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<28} {shown(name, value)}")
+            continue
+        ratio = value / base if base else 1.0
+        bad = ratio > 1 + tolerance(name)
+        if bad:
+            slower.append(name)
+        print(f"{name:<28} {shown(name, value)} {ratio:6.2f}x"
+              f"{'  SLOWER' if bad else ''}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--net',
+                        action='store_true',
+                        help="also run whole matches over loopback")
+    parser.add_argument('--net-sizes',
+                        type=int,
+                        nargs='+',
+                        default=NET_SIZES,
+                        help="connections per loopback run")
+    parser.add_argument('--net-duration', type=float, default=NET_DURATION)
+    parser.add_argument('--only',
+                        help="only the benchmarks whose name has this in it")
+    parser.add_argument('--output', default=RESULTS)
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=TOLERANCE,
+                        help="how much slower than the baseline is still ok, "
+                        "0.2 for 20%%")
+    parser.add_argument('--save-baseline',
+                        action='store_true',
+                        help="store the results as the baseline too")
+    parser.add_argument('--compare',
+                        nargs='?',
+                        const=BASELINE,
+                        metavar='BASELINE',
+                        help=f"compare with a baseline ({BASELINE} by "
+                        "default), exit 1 on a regression")
+    args = parser.parse_args()
+    global only, max_slowdown
+    only = args.only
+    max_slowdown = args.tolerance
+    # read before running anything, a missing baseline should not cost a run
+    baseline = {}
+    if args.compare:
+        try:
+            with open(args.compare) as file:
+                baseline = json.load(file)['results']
+        except FileNotFoundError:
+            parser.error(f"no baseline at {args.compare}, run with "
+                         "--save-baseline first")
+
+    results = {}
+    micro_benchmarks(results, LEVELS)
+    tick_benchmarks(results, LEVELS)
+    if args.net:
+        for size in args.net_sizes:
+            if selected(f'net_{size}.'):
+                net_benchmark(results, size, args.net_duration)
+
+    document = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'time': time.time(),
+        # seconds per call, bytes per second for bytes_per_bot
+        'results': results
+    }
+    with open(args.output, 'w') as file:
+        json.dump(document, file, indent=1, sort_keys=True)
+    if args.save_baseline:
+        with open(BASELINE, 'w') as file:
+            json.dump(document, file, indent=1, sort_keys=True)
+
+    print(f"{'benchmark':<28} {'us / bytes':>12} {'vs base':>7}")
+    slower = compare(results, baseline)
+    if slower:
+        print(f"{len(slower)} slower than {args.compare}: "
+              f"{', '.join(slower)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+# headless bots speaking the real wire protocol, for putting load on a
+# server. a bot is an asyncio protocol, so hundreds of them share one event
+# loop: it says hello, waits for its room, then sends one input per server
+# tick from an input pattern and reads every snapshot. it keeps the
+# snapshots' data fields (not the entities, that would cost more than
+# the server) to see which of its inputs the server applied, and times each
+# input from sending to the first snapshot that shows it applied.
+#
+#   bots = await connect_bots(ADDR, 100, 'random')
+#   await drive(bots, 30)   # 30 seconds of input, then disconnect
+#
+# loadtest.py runs them in one or more processes and reports the results
+
+import json
+import time
+import random
+import asyncio
+import collections
+
+from protocol import (FrameProtocol, FORMAT, pack_input, INPUT_LEFT,
+                      INPUT_RIGHT, INPUT_UP, INPUT_DOWN, INPUT_FIRE,
+                      INPUT_READY, INPUT_DISCONNECT)
+
+MOVES = (0, INPUT_LEFT, INPUT_RIGHT, INPUT_UP, INPUT_DOWN)
+# inputs a bot remembers while waiting for the server to apply them
+MAX_PENDING = 256
+# seconds connect_bots() waits for every bot to get a room
+JOIN_TIMEOUT = 30
+
+
+def idle(bot, seq):
+    # ready and nothing else, the game runs but the ship stays put
+    return INPUT_READY
+
+
+def strafe(bot, seq):
+    # left and right half a second each, firing all the time
+    half = max(1, bot.tick_rate // 2)
+    move = INPUT_LEFT if (seq // half) % 2 else INPUT_RIGHT
+    return INPUT_READY | INPUT_FIRE | move
+
+
+def mash(bot, seq):
+    # a new random move about four times a second, firing most of the time
+    if bot.rng.random() < 4 / bot.tick_rate:
+        bot.held = bot.rng.choice(MOVES)
+        if bot.rng.random() < 0.8:
+            bot.held |= INPUT_FIRE
+    return INPUT_READY | bot.held
+
+
+PATTERNS = {'idle': idle, 'strafe': strafe, 'random': mash}
+
+
+class Bot(FrameProtocol):
+
+    def __init__(self, pattern=mash, seed=None):
+        super().__init__()
+        self.pattern = pattern
+        self.rng = random.Random(seed)
+        self.held = 0
+        self.joined = asyncio.get_running_loop().create_future()
+        self.closed = asyncio.get_running_loop().create_future()
+        self.reply = None
+        self.tick_rate = 60
+        self.slot = None
+        self.tick = None
+        self.data = {}
+        self.seq = 0
+        # (seq, monotonic time sent) of inputs not applied yet
+        self.pending = collections.deque(maxlen=MAX_PENDING)
+        # seconds from sending an input to the snapshot that applied it
+        self.latencies = []
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.send_frame(b'hello')
+
+    def frame_received(self, frame):
+        now = time.monotonic()
+        msg = json.loads(str(frame, FORMAT))
+        if self.reply is None:
+            self.reply = msg
+            self.tick_rate = msg.get('tick_rate', self.tick_rate)
+            if not self.joined.done():
+                self.joined.set_result(msg)
+            return
+        # over tcp every delta builds on the snapshot before it, so the data
+        # fields stay exact without keeping the entities
+        self.tick = msg['tick']
+        self.data.update(msg['data'])
+        if self.slot is None:
+            me = [self.reply['ip'], self.reply['port']]
+            for slot in (1, 2):
+                if self.data.get(f'user{slot}') == me:
+                    self.slot = slot
+        if self.slot is not None:
+            applied = self.data.get(f'seq{self.slot}', 0)
+            pending = self.pending
+            while pending and pending[0][0] <= applied:
+                self.latencies.append(now - pending.popleft()[1])
+
+    def send_input(self, buttons=None):
+        if buttons is None:
+            buttons = self.pattern(self, self.seq + 1)
+        self.seq += 1
+        self.pending.append((self.seq, time.monotonic()))
+        self.send_frame(pack_input(buttons, self.seq, time.time(), self.tick))
+
+    def disconnect(self):
+        if not self.transport.is_closing():
+            self.send_input(INPUT_DISCONNECT)
+
+    def connection_lost(self, exc):
+        if not self.joined.done():
+            self.joined.set_exception(exc or ConnectionError("closed"))
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+async def connect_bots(addr, count, pattern='random', batch=50, seed=None,
+                       join_timeout=JOIN_TIMEOUT):
+    # count bots, connected batch at a time so the listen backlog keeps up.
+    # returns the bots that got a room within join_timeout seconds, the rest
+    # are still in the server's lobby (it seats two per room, --max-rooms)
+    # and get disconnected
+    loop = asyncio.get_running_loop()
+    pattern = PATTERNS.get(pattern, pattern)
+    rng = random.Random(seed)
+    bots = []
+    for start in range(0, count, batch):
+        connections = await asyncio.gather(*[
+            loop.create_connection(
+                lambda: Bot(pattern, rng.getrandbits(32)), *addr)
+            for i in range(min(batch, count - start))
+        ])
+        bots.extend(bot for transport, bot in connections)
+    await asyncio.wait([bot.joined for bot in bots], timeout=join_timeout)
+    joined = []
+    for bot in bots:
+        if bot.joined.done():
+            if bot.joined.exception() is None:
+                joined.append(bot)
+        else:
+            bot.joined.cancel()
+            bot.transport.close()
+    if len(joined) < count:
+        print(f"[BOTS] {count - len(joined)} of {count} bots got no room "
+              f"within {join_timeout:g}s, going on without them")
+    return joined
+
+
+async def drive(bots, duration):
+    # every bot sends one input per server tick for duration seconds, then
+    # they all disconnect and are waited for
+    if not bots:
+        return
+    loop = asyncio.get_running_loop()
+    tick_rate = max(bot.tick_rate for bot in bots)
+    interval = 1.0 / tick_rate
+    end = loop.time() + duration
+    next_input = loop.time()
+    while loop.time() < end:
+        for bot in bots:
+            if not bot.transport.is_closing():
+                bot.send_input()
+        next_input += interval
+        await asyncio.sleep(max(0, next_input - loop.time()))
+    for bot in bots:
+        bot.disconnect()
+    await asyncio.wait([bot.closed for bot in bots], timeout=5)
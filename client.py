@@ -1,13 +1,19 @@
 import socket
-import json
 import pygame
 import os
 import time
 import random
+import collections
+
+import snapshots
+from netclient import NetworkClient
+from interpolation import SnapshotBuffer
+from protocol import (INPUT_LEFT, INPUT_RIGHT, INPUT_UP, INPUT_DOWN,
+                      INPUT_FIRE, INPUT_READY, INPUT_DISCONNECT)
+from rules import WIDTH, HEIGHT, PLAYER_SPEED, per_tick, move_player
 
 pygame.font.init()
 
-WIDTH, HEIGHT = 750, 750
 WIN = pygame.display.set_mode((WIDTH, HEIGHT))
 pygame.display.set_caption("Space Shooter Tutorial")
 
@@ -36,45 +42,46 @@ BG = pygame.transform.scale(
     pygame.image.load(os.path.join("assets", "background-black.png")),
     (WIDTH, HEIGHT))
 
+# remote entities are drawn this many seconds behind the server, smoothed
+# between snapshots
+INTERPOLATION_DELAY = 0.1
+
+# take snapshots and send inputs over udp when the server offers it
+USE_UDP = True
+
+# None to play, 0 to watch whichever room is running, a room id to watch
+# that room
+WATCH = None
+
 # network
 ready = False
-HEADER = 64
 PORT = 5050
-FORMAT = 'utf-8'
-DISCONNECT_MESSAGE = '!DISCONNECT'
 SERVER = socket.gethostbyname(socket.gethostname())
 ADDR = (SERVER, PORT)
 
-client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-client.connect(ADDR)
+net = NetworkClient(ADDR, USE_UDP, WATCH)
 
 data = {}
 
 
-def send_dict(msg):
-    msg_str = json.dumps(msg)
-    message = msg_str.encode(FORMAT)
-    msg_length = len(message)
-    send_length = str(msg_length).encode(FORMAT)
-    send_length += b' ' * (HEADER - len(send_length))
-    client.send(send_length)
-    client.send(message)
-    #print(client.recv(2048).decode(FORMAT))
-
-
-def send(msg):
-    message = msg.encode(FORMAT)
-    msg_length = len(message)
-    send_length = str(msg_length).encode(FORMAT)
-    send_length += b' ' * (HEADER - len(send_length))
-    client.send(send_length)
-    client.send(message)
-    #print(client.recv(2048).decode(FORMAT))
-
-
-# send_dict(data)
-
-#send(DISCONNECT_MESSAGE)
+def input_buttons(keys, user_data):
+    # only the few actions the game uses go to the server, as a bitmask
+    buttons = 0
+    if keys[pygame.K_a]:
+        buttons |= INPUT_LEFT
+    if keys[pygame.K_d]:
+        buttons |= INPUT_RIGHT
+    if keys[pygame.K_w]:
+        buttons |= INPUT_UP
+    if keys[pygame.K_s]:
+        buttons |= INPUT_DOWN
+    if keys[pygame.K_SPACE]:
+        buttons |= INPUT_FIRE
+    if user_data['ready']:
+        buttons |= INPUT_READY
+    if not user_data['connection']:
+        buttons |= INPUT_DISCONNECT
+    return buttons
 
 #---------------------------------------------game body---------------------------------------------
 
@@ -85,19 +92,13 @@ class Laser:
         self.x = x
         self.y = y
         self.img = img
-        self.mask = pygame.mask.from_surface(self.img)
 
     def draw(self, window):
         window.blit(self.img, (self.x, self.y))
 
-    def move(self, vel):
-        self.y += vel
-
-    def off_screen(self, height):
-        return not (self.y <= height and self.y >= 0)
-
-    def collision(self, obj):
-        return collide(self, obj)
+    def update(self, fields):
+        self.x = fields['x']
+        self.y = fields['y']
 
 
 class Ship:
@@ -109,35 +110,16 @@ class Ship:
         self.health = health
         self.ship_img = None
         self.laser_img = None
-        self.lasers = []
+        self.lasers = EntityStore(self.new_laser)
         self.cool_down_counter = 0
 
     def draw(self, window):
         window.blit(self.ship_img, (self.x, self.y))
-        for laser in self.lasers:
+        for laser in self.lasers.values():
             laser.draw(window)
 
-    def move_lasers(self, vel, obj):
-        self.cooldown()
-        for laser in self.lasers:
-            laser.move(vel)
-            if laser.off_screen(HEIGHT):
-                self.lasers.remove(laser)
-            elif laser.collision(obj):
-                obj.health -= 10
-                self.lasers.remove(laser)
-
-    def cooldown(self):
-        if self.cool_down_counter >= self.COOLDOWN:
-            self.cool_down_counter = 0
-        elif self.cool_down_counter > 0:
-            self.cool_down_counter += 1
-
-    # def shoot(self):
-    #     if self.cool_down_counter == 0:
-    #         laser = Laser(self.x, self.y, self.laser_img)
-    #         self.lasers.append(laser)
-    #         self.cool_down_counter = 1
+    def new_laser(self, fields):
+        return Laser(fields['x'], fields['y'], self.laser_img)
 
     def get_width(self):
         return self.ship_img.get_width()
@@ -152,35 +134,14 @@ class Player(Ship):
         super().__init__(x, y, health)
         self.ship_img = YELLOW_SPACE_SHIP
         self.laser_img = YELLOW_LASER
-        self.mask = pygame.mask.from_surface(self.ship_img)
         self.max_health = health
 
-    def move_lasers(self, vel, objs):
-        self.cooldown()
-        for laser in self.lasers:
-            laser.move(vel)
-            if laser.off_screen(HEIGHT):
-                self.lasers.remove(laser)
-            else:
-                for obj in objs:
-                    if laser.collision(obj):
-                        objs.remove(obj)
-                        if laser in self.lasers:
-                            self.lasers.remove(laser)
-
     def draw(self, window):
         super().draw(window)
         self.healthbar(window)
 
-    def laser_render(self, layser_list):
-        self.lasers = []
-        for i in range(len(layser_list)):
-            laser = Laser(layser_list[i]['x'], layser_list[i]['y'],
-                          YELLOW_LASER)
-            # laser = Laser(self.x, self.y, YELLOW_LASER)
-            self.lasers.append(laser)
-
-        #self.cool_down_counter = 1
+    def laser_render(self, lasers_data, buffer, kind):
+        self.lasers.sync(lasers_data, buffer, kind)
 
     def healthbar(self, window):
         pygame.draw.rect(window, (255, 0, 0),
@@ -202,25 +163,70 @@ class Enemy(Ship):
     def __init__(self, x, y, color, health=100):
         super().__init__(x, y, health)
         self.ship_img, self.laser_img = self.COLOR_MAP[color]
-        self.mask = pygame.mask.from_surface(self.ship_img)
-
-    def move(self, vel):
-        self.y += vel
-
-    # def shoot(self):
-    #     if self.cool_down_counter == 0:
-    #         laser = Laser(self.x-20, self.y, self.laser_img)
-    #         self.lasers.append(laser)
-    #         self.cool_down_counter = 1
-
-
-def collide(obj1, obj2):
-    offset_x = obj2.x - obj1.x
-    offset_y = obj2.y - obj1.y
-    return obj1.mask.overlap(obj2.mask, (offset_x, offset_y)) != None
-
 
-enemies = []
+    @classmethod
+    def from_fields(cls, fields):
+        return cls(fields['ex'], fields['ey'], fields['ecolor'])
+
+    def update(self, fields):
+        self.x = fields['ex']
+        self.y = fields['ey']
+
+
+class EntityStore:
+    # the client's copies of one kind of server entity, keyed by entity id.
+    # objects live as long as the entity does: sync() moves the ones we
+    # already have, creates the ones we see for the first time and drops the
+    # ones the server removed, so a frame allocates nothing for the rest.
+    # entities are drawn a little in the past, so which ones are on screen
+    # comes from the snapshot buffer: a new one shows up once the buffer
+    # reaches its first tick, a removed one stays until it passes its last.
+    # the client only draws, it never builds collision masks
+
+    def __init__(self, create):
+        self.create = create
+        self.objects = {}
+        # the objects that exist at the moment drawn, from interpolate()
+        self.drawn = []
+
+    def sync(self, entities, buffer, kind):
+        objects = self.objects
+        for eid, fields in entities.items():
+            obj = objects.get(eid)
+            if obj is None:
+                objects[eid] = self.create(fields)
+            else:
+                obj.update(fields)
+        # every entity is in objects now, anything extra is gone on the
+        # server, and once the buffer is past it gone from the screen too
+        if len(objects) > len(entities):
+            for eid in [
+                    eid for eid in objects
+                    if eid not in entities and not buffer.has(kind, eid)
+            ]:
+                del objects[eid]
+
+    def interpolate(self, buffer, kind):
+        # move every object to where the buffer has it for this frame, and
+        # leave out the ones that don't exist at that moment
+        drawn = self.drawn
+        drawn.clear()
+        for eid, obj in self.objects.items():
+            position = buffer.position(kind, eid, (obj.x, obj.y))
+            if position is not None:
+                obj.x, obj.y = position
+                drawn.append(obj)
+
+    def values(self):
+        # what to draw this frame
+        return self.drawn
+
+    def __len__(self):
+        return len(self.objects)
+
+
+enemies = EntityStore(Enemy.from_fields)
+world = snapshots.new_state()
 data_dict = {
     'ready': False,
     'level': 0,
@@ -237,16 +243,24 @@ data_dict = {
 }
 
 
-def main(addr):
+def main(addr, tick_rate):
     win2 = False  # for printing it
     lost2 = False
     user_data = {'connection': True, 'ready': False}
+    input_seq = 0
+    # inputs the server hasn't applied yet: (seq, buttons, vel)
+    pending = collections.deque(maxlen=2 * tick_rate)
+    buffer = SnapshotBuffer(tick_rate, INTERPOLATION_DELAY)
     global data_dict
     global enemies
+    global world
     global data
     run = True
     FPS = 60
     level = 0
+    # inputs go out once per server tick, whatever the frame rate
+    input_interval = 1.0 / tick_rate
+    next_input = time.monotonic()
 
     small_font = pygame.font.SysFont("comicsans", 13)
     main_font = pygame.font.SysFont("comicsans", 30)
@@ -278,7 +292,7 @@ def main(addr):
         WIN.blit(user2, (10, 28))
         WIN.blit(level_label, (WIDTH - level_label.get_width() - 10, 10))
 
-        for enemy in enemies:
+        for enemy in enemies.values():
             enemy.draw(WIN)
 
         player.draw(WIN)
@@ -361,146 +375,109 @@ def main(addr):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 user_data['connection'] = False
-                send_dict(user_data)
-                #quit()
-
-        send_dict(user_data)
-
-        # for i in range(0, len(keys)):
-        #     if keys[i]:
-        #         print(i)
-
-        data_str = json.dumps(keys)
-        send(data_str)
-
-        while True:
-            msg_length = client.recv(HEADER).decode(FORMAT)
-            if msg_length:
-                msg_length = int(msg_length)
-                data_received = client.recv(msg_length).decode(FORMAT)
-                break
-
-        # data_received = client.recv(4096).decode(FORMAT)
-        data_dict = json.loads(data_received)
-        #print(data_str)
+        if net.watch is not None and not user_data['connection']:
+            return False
+
+        # move our own ship right away with the server's rules, the server
+        # confirms it a round trip later
+        now = time.monotonic()
+        if next_input < now - 1:
+            next_input = now
+        while next_input <= now and net.watch is None:
+            next_input += input_interval
+            input_seq += 1
+            buttons = input_buttons(keys, user_data)
+            net.send_input(buttons, input_seq)
+            if data_dict['ready']:
+                vel = per_tick(PLAYER_SPEED, tick_rate, input_seq)
+            else:
+                vel = 0
+            pending.append((input_seq, buttons, vel))
+            player.x, player.y = move_player(player.x, player.y, buttons, vel,
+                                             player.get_width(),
+                                             player.get_height())
+
+        # take whatever snapshots the network thread has, never wait for one
+        received = False
+        for arrived, state in net.take_states():
+            world = state
+            received = True
+            buffer.push(world['tick'], world, arrived)
+        if net.closed:
+            return False
+        if world['tick'] is not None:
+            data_dict = world['data']
+        buffer.sample()
 
         pygame.event.pump()
 
         level = data_dict['level']
 
         if addr == data_dict['user1']:
-            player.x = data_dict['x1']
-            player.y = data_dict['y1']
-            player.health = data_dict['health1']
-            if data_dict['win1']:
-                win = True
-            player2.x = data_dict['x2']
-            player2.y = data_dict['y2']
-            player2.health = data_dict['health2']
-            if data_dict['win2']:
-                lost = True
-
+            me, other = 1, 2
         elif addr == data_dict['user2']:
-            player.x = data_dict['x2']
-            player.y = data_dict['y2']
-            player.health = data_dict['health2']
-            if data_dict['win2']:
+            me, other = 2, 1
+        else:
+            me = other = None
+
+        if me is not None:
+            if received:
+                # start from where the server has us and replay the inputs
+                # it hasn't applied yet
+                acked_seq = data_dict[f'seq{me}']
+                while pending and pending[0][0] <= acked_seq:
+                    pending.popleft()
+                x, y = data_dict[f'x{me}'], data_dict[f'y{me}']
+                for seq, pending_buttons, pending_vel in pending:
+                    x, y = move_player(x, y, pending_buttons, pending_vel,
+                                       player.get_width(), player.get_height())
+                player.x, player.y = x, y
+            player.health = data_dict[f'health{me}']
+            if data_dict[f'win{me}']:
                 win = True
-            player2.x = data_dict['x1']
-            player2.y = data_dict['y1']
-            player2.health = data_dict['health1']
-            if data_dict['win1']:
+            # everything but our own ship is drawn from the buffer
+            player2.x, player2.y = buffer.position(
+                'players', other,
+                (data_dict[f'x{other}'], data_dict[f'y{other}']))
+            player2.health = data_dict[f'health{other}']
+            if data_dict[f'win{other}']:
                 lost = True
 
-        #send("hello")
+            player.laser_render(world[f'lasers{me}'], buffer, f'lasers{me}')
+            player2.laser_render(world[f'lasers{other}'], buffer,
+                                 f'lasers{other}')
+            player.lasers.interpolate(buffer, f'lasers{me}')
+            player2.lasers.interpolate(buffer, f'lasers{other}')
+        elif net.watch is not None:
+            # spectating: both ships come from the buffer
+            for slot, ship in ((1, player), (2, player2)):
+                ship.x, ship.y = buffer.position(
+                    'players', slot,
+                    (data_dict[f'x{slot}'], data_dict[f'y{slot}']))
+                ship.health = data_dict[f'health{slot}']
+                ship.laser_render(world[f'lasers{slot}'], buffer,
+                                  f'lasers{slot}')
+                ship.lasers.interpolate(buffer, f'lasers{slot}')
 
         pygame.event.pump()
-        if addr == data_dict['user1']:
-
-            # laser_str = client.recv(4096).decode(FORMAT)
-            while True:
-                msg_length = client.recv(HEADER).decode(FORMAT)
-                if msg_length:
-                    msg_length = int(msg_length)
-                    laser_str = client.recv(msg_length).decode(FORMAT)
-                    break
-            laser_list = json.loads(laser_str)
-            player.laser_render(laser_list)
-
-            # send("hello")
-
-            # laser_str = client.recv(4096).decode(FORMAT)
-            while True:
-                msg_length = client.recv(HEADER).decode(FORMAT)
-                if msg_length:
-                    msg_length = int(msg_length)
-                    laser_str = client.recv(msg_length).decode(FORMAT)
-                    break
-            laser_list = json.loads(laser_str)
-            player2.laser_render(laser_list)
 
-        elif addr == data_dict['user2']:
-            # laser_str = client.recv(4096).decode(FORMAT)
-            while True:
-                msg_length = client.recv(HEADER).decode(FORMAT)
-                if msg_length:
-                    msg_length = int(msg_length)
-                    laser_str = client.recv(msg_length).decode(FORMAT)
-                    break
-            laser_list = json.loads(laser_str)
-            player2.laser_render(laser_list)
-
-            # send("hello")
-
-            # laser_str = client.recv(4096).decode(FORMAT)
-            while True:
-                msg_length = client.recv(HEADER).decode(FORMAT)
-                if msg_length:
-                    msg_length = int(msg_length)
-                    laser_str = client.recv(msg_length).decode(FORMAT)
-                    break
-            laser_list = json.loads(laser_str)
-            player.laser_render(laser_list)
-
-        #laser_list = json.loads(laser_str)
-        #player.shoot(laser_list)
-        pygame.event.pump()
-
-        # enmies_data_str = client.recv(65536).decode(FORMAT)
-        while True:
-            msg_length = client.recv(HEADER).decode(FORMAT)
-            if msg_length:
-                msg_length = int(msg_length)
-                enmies_data_str = client.recv(msg_length).decode(FORMAT)
-                break
-
-        enemies_data = json.loads(enmies_data_str)
-        enemies = []
-        for i in range(len(enemies_data)):
-            enemy = Enemy(enemies_data[i]['ex'], enemies_data[i]['ey'],
-                          enemies_data[i]['ecolor'])
-            enemies.append(enemy)
+        enemies.sync(world['enemies'], buffer, 'enemies')
+        enemies.interpolate(buffer, 'enemies')
 
 
 def main_menu():
 
-    send("hello")
-    # addr_str = client.recv(2048).decode(FORMAT)
-    while True:
-        msg_length = client.recv(HEADER).decode(FORMAT)
-        if msg_length:
-            msg_length = int(msg_length)
-            addr_str = client.recv(msg_length).decode(FORMAT)
-            break
-
-    addr_dict = json.loads(addr_str)
+    addr_dict = net.handshake()
+    net.start()
     addr = [addr_dict['ip'], addr_dict['port']]
+    tick_rate = addr_dict.get('tick_rate', 60)
     title_font = pygame.font.SysFont("comicsans", 70)
     run = True
     while run:
 
-        main(addr)
+        run = main(addr, tick_rate)
 
+    net.close()
     pygame.quit()
 
 
@@ -0,0 +1,82 @@
+# collision detection in two phases: a uniform grid (spatial hash) and a
+# bounding box test pick the few pairs that could touch, and only those get
+# the pixel-perfect pygame.mask overlap test
+
+CELL_SIZE = 64
+
+
+def box(obj):
+    # (left, top, right, bottom) of the opaque part of the object's sprite,
+    # tighter than the whole image so fewer pairs reach the mask test
+    dx, dy, width, height = obj.sprite.bounds
+    left = obj.x + dx
+    top = obj.y + dy
+    return left, top, left + width, top + height
+
+
+def boxes_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def collide(obj1, obj2):
+    offset_x = obj2.x - obj1.x
+    offset_y = obj2.y - obj1.y
+    return obj1.mask.overlap(obj2.mask, (offset_x, offset_y)) != None
+
+
+class SpatialHash:
+    # objects are stored in every cell their bounding box touches, rebuilt
+    # once per tick with build() and then queried as often as needed
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.boxes = {}
+
+    def build(self, objs):
+        self.cells = {}
+        self.boxes = {}
+        for obj in objs:
+            self.insert(obj)
+
+    def cell_range(self, rect):
+        size = self.cell_size
+        return (range(int(rect[0] // size), int((rect[2] - 1) // size) + 1),
+                range(int(rect[1] // size), int((rect[3] - 1) // size) + 1))
+
+    def insert(self, obj):
+        rect = box(obj)
+        self.boxes[obj] = rect
+        columns, rows = self.cell_range(rect)
+        for cx in columns:
+            for cy in rows:
+                cell = self.cells.get((cx, cy))
+                if cell is None:
+                    self.cells[(cx, cy)] = [obj]
+                else:
+                    cell.append(obj)
+
+    def query(self, obj):
+        # everything whose bounding box overlaps obj's
+        rect = box(obj)
+        found = []
+        seen = set()
+        columns, rows = self.cell_range(rect)
+        for cx in columns:
+            for cy in rows:
+                for other in self.cells.get((cx, cy), ()):
+                    if other in seen:
+                        continue
+                    seen.add(other)
+                    if boxes_overlap(rect, self.boxes[other]):
+                        found.append(other)
+        return found
+
+    def collisions(self, obj):
+        # everything that touches obj pixel-perfectly
+        return [other for other in self.query(obj) if collide(obj, other)]
+
+    def batch(self, objs):
+        # (obj, other) for every colliding pair between objs and the grid
+        return [(obj, other) for obj in objs
+                for other in self.collisions(obj)]
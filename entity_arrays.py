@@ -0,0 +1,252 @@
+# struct-of-arrays enemy storage for very large rooms. instead of one Enemy
+# object per ship the room keeps a numpy array per field, moves, culls and
+# compacts them in whole-array passes and writes snapshots straight from the
+# arrays. plays exactly like Simulation: same random calls, same rules, same
+# world states, so a recorded match replays the same with either. the
+# snapshot deltas are worked out on the arrays as well: a wave moving down
+# together is one 'move' instead of an update per enemy. needs numpy,
+# server.py only offers it when numpy is installed
+
+import collections.abc
+
+import numpy as np
+
+import snapshots
+from simulation import (Simulation, Enemy, entity_ids, WIDTH, HEIGHT,
+                        VIEW_MARGIN)
+
+COLORS = ("red", "green", "blue")
+COLOR_INDEX = {color: index for index, color in enumerate(COLORS)}
+
+# per color lookup tables, indexed with the kind column
+SHIP_SPRITES = [Enemy.COLOR_MAP[color][0] for color in COLORS]
+MASKS = [sprite.mask for sprite in SHIP_SPRITES]
+WIDTHS = np.array([sprite.width for sprite in SHIP_SPRITES], dtype=np.int64)
+HEIGHTS = np.array([sprite.height for sprite in SHIP_SPRITES], dtype=np.int64)
+BOUNDS = np.array([sprite.bounds for sprite in SHIP_SPRITES], dtype=np.int64)
+NO_IDS = np.zeros(0, dtype=np.int64)
+LASER_KINDS = tuple(kind for kind in snapshots.ENTITY_KINDS
+                    if kind != 'enemies')
+
+
+class EntityArrays:
+    # one row per entity, rows stay in spawn order so snapshots list them in
+    # the same order as the object version does. alive marks rows to drop on
+    # the next compact()
+
+    COLUMNS = ('id', 'x', 'y', 'kind')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        for column in self.COLUMNS:
+            setattr(self, column, np.zeros(0, dtype=np.int64))
+        self.alive = np.zeros(0, dtype=bool)
+
+    def __len__(self):
+        return len(self.id)
+
+    def spawn(self, ids, xs, ys, kinds):
+        for column, values in zip(self.COLUMNS, (ids, xs, ys, kinds)):
+            setattr(self, column,
+                    np.concatenate((getattr(self, column),
+                                    np.asarray(values, dtype=np.int64))))
+        self.alive = np.concatenate(
+            (self.alive, np.ones(len(ids), dtype=bool)))
+
+    def move(self, vel):
+        self.y += vel
+
+    def compact(self):
+        # drop every row that is no longer alive, in one pass per column
+        if self.alive.all():
+            return
+        keep = self.alive
+        for column in self.COLUMNS:
+            setattr(self, column, getattr(self, column)[keep])
+        self.alive = np.ones(len(self.id), dtype=bool)
+
+    def states(self, view):
+        # the rows overlapping view (left, top, right, bottom), and the ids
+        # of the rest
+        left, top, right, bottom = view
+        x, y, kind = self.x, self.y, self.kind
+        inside = ((x < right) & (y < bottom) & (x + WIDTHS[kind] > left)
+                  & (y + HEIGHTS[kind] > top))
+        return (EnemyRows(self.id[inside], x[inside], y[inside],
+                          kind[inside]), self.id[~inside])
+
+
+class EnemyRows(collections.abc.Mapping):
+    # one tick's enemies in view, copies of the array columns. reads like
+    # the {id: fields} dict Simulation puts in a state, but that dict is only
+    # built when someone asks (replay checksums), enemy_delta() works on the
+    # columns. ids are in spawn order, so sorted
+
+    def __init__(self, ids, x, y, kind):
+        self.id = ids
+        self.x = x
+        self.y = y
+        self.kind = kind
+        self.states = None
+
+    def fields(self, rows):
+        colors = COLORS
+        return {
+            eid: {
+                'ex': x,
+                'ey': y,
+                'ecolor': colors[kind]
+            }
+            for eid, x, y, kind in zip(self.id[rows].tolist(),
+                                       self.x[rows].tolist(),
+                                       self.y[rows].tolist(),
+                                       self.kind[rows].tolist())
+        }
+
+    def as_dict(self):
+        if self.states is None:
+            self.states = self.fields(slice(None))
+        return self.states
+
+    def __getitem__(self, eid):
+        return self.as_dict()[eid]
+
+    def __iter__(self):
+        return iter(self.as_dict())
+
+    def __len__(self):
+        return len(self.id)
+
+    def values(self):
+        return self.as_dict().values()
+
+    def items(self):
+        return self.as_dict().items()
+
+
+EMPTY_ROWS = EnemyRows(NO_IDS, NO_IDS, NO_IDS, NO_IDS)
+
+
+def enemy_delta(base, state):
+    # the 'enemies' entry of snapshots.delta() for two states of an
+    # ArraySimulation, from their columns. the rows both have are moved by
+    # the y step most of them share, the few that moved otherwise are
+    # updated one by one
+    old = base['enemies']
+    if not isinstance(old, EnemyRows):
+        old = EMPTY_ROWS  # a keyframe, from snapshots.new_state()
+    new = state['enemies']
+    was_hidden = base.get('hidden', {}).get('enemies', NO_IDS)
+    common, before, after = np.intersect1d(old.id,
+                                           new.id,
+                                           assume_unique=True,
+                                           return_indices=True)
+    entry = {}
+    fresh = np.ones(len(new.id), dtype=bool)
+    fresh[after] = False
+    if fresh.any():
+        rows = np.flatnonzero(fresh)
+        entered = np.isin(new.id[rows], was_hidden, assume_unique=True)
+        if not entered.all():
+            entry['spawn'] = new.fields(rows[~entered])
+        if entered.any():
+            entry['enter'] = new.fields(rows[entered])
+    if len(common):
+        dy = new.y[after] - old.y[before]
+        step = int(np.median(dy))
+        if step:
+            entry['move'] = {'ey': step}
+        odd = ((dy != step) | (new.x[after] != old.x[before])
+               | (new.kind[after] != old.kind[before]))
+        if odd.any():
+            entry['update'] = new.fields(after[odd])
+    gone = np.ones(len(old.id), dtype=bool)
+    gone[before] = False
+    if gone.any():
+        ids = old.id[gone]
+        left = np.isin(ids, state['hidden']['enemies'], assume_unique=True)
+        if not left.all():
+            entry['despawn'] = ids[~left].tolist()
+        if left.any():
+            entry['leave'] = ids[left].tolist()
+    return entry
+
+
+class ArraySimulation(Simulation):
+    # Simulation with its enemies in an EntityArrays. players and lasers stay
+    # objects, there are only a handful of them per room
+
+    def __init__(self, tick_rate=60, seed=None, view_margin=VIEW_MARGIN):
+        self.boxes = None
+        super().__init__(tick_rate, seed, view_margin)
+
+    def new_enemies(self):
+        return EntityArrays()
+
+    def spawn_wave(self):
+        self.level += 1
+        self.wave_length += 10
+        count = self.wave_length
+        rng = self.random
+        ids, xs, ys, kinds = [], [], [], []
+        for i in range(count):
+            ids.append(next(entity_ids))
+            xs.append(rng.randrange(50, WIDTH - 100))
+            ys.append(rng.randrange(-1500, -100))
+            kinds.append(COLOR_INDEX[rng.choice(["red", "blue", "green"])])
+        self.enemies.spawn(ids, xs, ys, kinds)
+
+    def move_enemies(self):
+        enemies = self.enemies
+        enemies.move(self.enemy_vel)
+        enemies.alive &= enemies.y + HEIGHTS[enemies.kind] <= HEIGHT
+        enemies.compact()
+
+    def index_enemies(self):
+        # the opaque bounds of every enemy, (left, top, right, bottom)
+        enemies = self.enemies
+        bounds = BOUNDS[enemies.kind]
+        left = enemies.x + bounds[:, 0]
+        top = enemies.y + bounds[:, 1]
+        self.boxes = (left, top, left + bounds[:, 2], top + bounds[:, 3])
+
+    def enemy_hits(self, obj):
+        # bounding boxes are tested against every enemy at once, only the
+        # rows that overlap get the mask test. returns row numbers
+        dx, dy, width, height = obj.sprite.bounds
+        left = obj.x + dx
+        top = obj.y + dy
+        right = left + width
+        bottom = top + height
+        e_left, e_top, e_right, e_bottom = self.boxes
+        rows = np.flatnonzero((e_left < right) & (left < e_right)
+                              & (e_top < bottom) & (top < e_bottom))
+        if not len(rows):
+            return []
+        enemies = self.enemies
+        hits = []
+        for row, x, y, kind in zip(rows.tolist(), enemies.x[rows].tolist(),
+                                   enemies.y[rows].tolist(),
+                                   enemies.kind[rows].tolist()):
+            if obj.mask.overlap(MASKS[kind], (x - obj.x, y - obj.y)):
+                hits.append(row)
+        return hits
+
+    def remove_enemies(self, dead):
+        self.enemies.alive[list(dead)] = False
+        self.enemies.compact()
+
+    def clear_enemies(self):
+        self.enemies.clear()
+
+    def enemy_states(self):
+        return self.enemies.states(self.view)
+
+    def delta(self, base, state):
+        msg = snapshots.delta(base, state, LASER_KINDS)
+        entry = enemy_delta(base, state)
+        if entry:
+            msg['enemies'] = entry
+        return msg
@@ -0,0 +1,133 @@
+# snapshot interpolation for the client. snapshots arrive whenever the
+# network delivers them, so drawing the latest one as it comes makes every
+# bit of jitter visible. instead the client draws remote entities a fixed
+# delay in the past, between the two snapshots around that moment, and
+# keeps them moving for a little while when the next snapshot is late
+
+import time
+import collections
+
+from snapshots import ENTITY_KINDS
+
+# how far behind the server the client draws, in seconds
+DELAY = 0.1
+# how long entities keep moving on their own when snapshots stop coming
+MAX_EXTRAPOLATION = 0.1
+
+
+def positions(world):
+    # what gets interpolated out of a world state: {kind: {id: (x, y)}}, the
+    # two players under 'players'
+    data = world['data']
+    result = {
+        'players': {
+            slot: (data[f'x{slot}'], data[f'y{slot}']) for slot in (1, 2)
+        },
+        'enemies': {
+            eid: (fields['ex'], fields['ey'])
+            for eid, fields in world['enemies'].items()
+        }
+    }
+    for kind in ENTITY_KINDS:
+        if kind != 'enemies':
+            result[kind] = {
+                eid: (fields['x'], fields['y'])
+                for eid, fields in world[kind].items()
+            }
+    return result
+
+
+class SnapshotBuffer:
+
+    def __init__(self,
+                 tick_rate,
+                 delay=DELAY,
+                 max_extrapolation=MAX_EXTRAPOLATION,
+                 size=32):
+        self.tick_rate = tick_rate
+        self.delay = delay
+        self.max_extrapolation = max_extrapolation
+        # (tick, positions), oldest first
+        self.snapshots = collections.deque(maxlen=size)
+        # local time minus server time, from the snapshots' arrival times
+        self.offset = None
+        self.older = None
+        self.newer = None
+        self.alpha = 0.0
+
+    def push(self, tick, world, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.snapshots and tick <= self.snapshots[-1][0]:
+            return
+        self.snapshots.append((tick, positions(world)))
+        # the fastest arrival is the closest to the real offset: jump down to
+        # it, drift up slowly so a changing route is picked up as well
+        sample = now - tick / self.tick_rate
+        if self.offset is None or sample < self.offset:
+            self.offset = sample
+        else:
+            self.offset += (sample - self.offset) * 0.05
+
+    def render_tick(self, now=None):
+        # the server tick to draw right now, a fraction most of the time
+        if now is None:
+            now = time.monotonic()
+        return (now - self.offset - self.delay) * self.tick_rate
+
+    def sample(self, now=None):
+        # picks the two snapshots to blend for this frame, call once per
+        # frame before position()
+        snapshots = self.snapshots
+        if not snapshots:
+            self.older = self.newer = None
+            return
+        tick = self.render_tick(now)
+        if len(snapshots) == 1 or tick <= snapshots[0][0]:
+            self.older = self.newer = snapshots[0]
+            self.alpha = 0.0
+            return
+        if tick >= snapshots[-1][0]:
+            # late: carry on along the last two snapshots, but not forever
+            older, newer = snapshots[-2], snapshots[-1]
+            tick = min(tick,
+                       newer[0] + self.max_extrapolation * self.tick_rate)
+        else:
+            for index in range(len(snapshots) - 1, 0, -1):
+                if snapshots[index - 1][0] <= tick:
+                    older, newer = snapshots[index - 1], snapshots[index]
+                    break
+        self.older = older
+        self.newer = newer
+        self.alpha = (tick - older[0]) / (newer[0] - older[0])
+
+    def position(self, kind, eid, default):
+        # where entity eid of kind is at the sampled moment: default while
+        # there are no snapshots, None when it doesn't exist at that moment.
+        # one only in the newer snapshot spawned after the moment drawn, one
+        # only in the older is gone by the newer but still there now
+        if self.newer is None:
+            return default
+        after = self.newer[1][kind].get(eid)
+        before = self.older[1][kind].get(eid)
+        if before is None:
+            return after if self.alpha >= 1 else None
+        if after is None:
+            return before if self.alpha < 1 else None
+        if before is after:
+            return after
+        alpha = self.alpha
+        return (before[0] + (after[0] - before[0]) * alpha,
+                before[1] + (after[1] - before[1]) * alpha)
+
+    def has(self, kind, eid):
+        # whether entity eid is in a snapshot that is still to be drawn
+        if self.older is None:
+            return False
+        oldest = self.older[0]
+        for tick, positions in reversed(self.snapshots):
+            if tick < oldest:
+                break
+            if eid in positions[kind]:
+                return True
+        return False
@@ -0,0 +1,160 @@
+# load test over loopback: hundreds of bots (bots.py) play against a running
+# server for a while, then it reports what they saw and what the server
+# said about its ticks:
+#
+#   python server.py
+#   python loadtest.py --bots 400 --processes 4 --duration 30
+#
+# bytes and frames are counted by the bots, latency is from sending an
+# input to the first snapshot that applied it. the server's tick times come
+# from its 'stats' reply, polled every second (with --server-workers N each
+# worker is asked)
+#
+# the server seats two bots per room, so --bots can be at most twice its
+# --max-rooms (minus the rooms other players use). bots that get no room
+# within bots.JOIN_TIMEOUT seconds are dropped and counted
+
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import multiprocessing
+
+from bots import connect_bots, drive, PATTERNS
+from protocol import FrameReader, send_text
+
+PORT = 5050
+SERVER = socket.gethostbyname(socket.gethostname())
+STATS_INTERVAL = 1.0
+
+
+def run_process(addr, count, pattern, duration, seed):
+    # one process worth of bots, returns what they counted
+    return asyncio.run(run_bots(addr, count, pattern, duration, seed))
+
+
+async def run_bots(addr, count, pattern, duration, seed):
+    bots = await connect_bots(addr, count, pattern, seed=seed)
+    started = time.monotonic()
+    await drive(bots, duration)
+    elapsed = time.monotonic() - started
+    for bot in bots:
+        bot.transport.close()
+    return {
+        'bots': len(bots),
+        'unseated': count - len(bots),
+        'seconds': elapsed,
+        'bytes_in': sum(bot.bytes_in for bot in bots),
+        'bytes_out': sum(bot.bytes_out for bot in bots),
+        'frames_in': sum(bot.frames_in for bot in bots),
+        'frames_out': sum(bot.frames_out for bot in bots),
+        'latencies': [
+            latency for bot in bots for latency in bot.latencies
+        ]
+    }
+
+
+def server_stats(addr, worker=None):
+    hello = 'stats' if worker is None else f'stats {worker}'
+    with socket.create_connection(addr, timeout=5) as sock:
+        send_text(sock, hello)
+        return FrameReader(sock).read_json()
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def report(results, polls):
+    seconds = max(result['seconds'] for result in results)
+    total = {
+        key: sum(result[key] for result in results)
+        for key in ('bots', 'bytes_in', 'bytes_out', 'frames_in',
+                    'frames_out')
+    }
+    latencies = sorted(latency for result in results
+                       for latency in result['latencies'])
+    unseated = sum(result['unseated'] for result in results)
+    if unseated:
+        print(f"{unseated} bots got no room, the server seats two per room "
+              "(--max-rooms)")
+    if not total['bots']:
+        return
+    print(f"{total['bots']} bots for {seconds:.1f}s")
+    print(f"in:  {total['bytes_in'] / seconds / 1024:.1f} KiB/s, "
+          f"{total['frames_in'] / seconds:.0f} frames/s "
+          f"({total['bytes_in'] / seconds / total['bots']:.0f} B/s per bot)")
+    print(f"out: {total['bytes_out'] / seconds / 1024:.1f} KiB/s, "
+          f"{total['frames_out'] / seconds:.0f} frames/s")
+    print("input to snapshot: " + ", ".join(
+        f"p{round(fraction * 100)} {percentile(latencies, fraction) * 1000:.1f} ms"
+        for fraction in (0.5, 0.9, 0.99)) +
+          f", max {latencies[-1] * 1000 if latencies else 0:.1f} ms "
+          f"({len(latencies)} inputs)")
+    if polls:
+        p50 = sorted(poll['tick_p50'] for poll in polls)[len(polls) // 2]
+        p99 = max(poll['tick_p99'] for poll in polls)
+        worst = max(poll['tick_max'] for poll in polls)
+        rooms = max(poll['rooms'] for poll in polls)
+        print(f"server tick: p50 {p50 * 1000:.2f} ms, "
+              f"p99 {p99 * 1000:.2f} ms, max {worst * 1000:.2f} ms "
+              f"({rooms} rooms, {1000 / polls[0]['tick_rate']:.1f} ms budget)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=SERVER)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--bots',
+                        type=int,
+                        default=200,
+                        help="at most twice the server's --max-rooms")
+    parser.add_argument('--processes',
+                        type=int,
+                        default=1,
+                        help="bot processes, the bots are split between them")
+    parser.add_argument('--duration',
+                        type=float,
+                        default=30,
+                        help="seconds of input after every bot has a room")
+    parser.add_argument('--pattern',
+                        choices=sorted(PATTERNS),
+                        default='random')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--server-workers',
+                        type=int,
+                        default=0,
+                        help="the server runs --workers N, ask each for stats")
+    args = parser.parse_args()
+    addr = (args.host, args.port)
+    shares = [
+        args.bots // args.processes + (i < args.bots % args.processes)
+        for i in range(args.processes)
+    ]
+    jobs = [(addr, count, args.pattern, args.duration,
+             None if args.seed is None else args.seed + i)
+            for i, count in enumerate(shares) if count]
+    workers = [None] if args.server_workers == 0 else list(
+        range(args.server_workers))
+    polls = []
+    with multiprocessing.Pool(len(jobs)) as pool:
+        results = pool.starmap_async(run_process, jobs)
+        while not results.ready():
+            results.wait(STATS_INTERVAL)
+            for worker in workers:
+                try:
+                    stats = server_stats(addr, worker)
+                except (OSError, ValueError):
+                    continue
+                if stats['ticks']:
+                    polls.append(stats)
+        results = results.get()
+    report(results, polls)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
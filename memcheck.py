@@ -0,0 +1,70 @@
+# how much memory the server's entities take, measured with tracemalloc.
+# run it after touching the entity classes, it exits with 1 when a laser or
+# an enemy grows past its budget:
+#
+#   python memcheck.py
+
+import gc
+import sys
+import tracemalloc
+
+from simulation import Laser, Enemy, SPRITES, LASERS, ENEMIES
+
+# bytes per live entity, everything it allocates included (its entity id too)
+LASER_BUDGET = 112
+ENEMY_BUDGET = 224
+COUNT = 10000
+
+
+def bytes_per_object(make, count=COUNT):
+    # make() is called count times, the objects are kept alive while the
+    # traced memory is compared
+    gc.collect()
+    tracemalloc.start()
+    try:
+        objs = [None] * count
+        before = tracemalloc.get_traced_memory()[0]
+        for i in range(count):
+            objs[i] = make()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (after - before) / count
+
+
+def collections_per_wave(spawn, release, waves=100, count=1000):
+    # garbage collector runs while waves of count entities come and go, a
+    # measure of the allocation churn the entities cause
+    gc.collect()
+    before = gc.get_stats()[0]['collections']
+    for wave in range(waves):
+        release([spawn() for i in range(count)])
+    return (gc.get_stats()[0]['collections'] - before) / waves
+
+
+def main():
+    laser = SPRITES['laser_yellow']
+    checks = [
+        ('laser', lambda: Laser(100, 100, laser), LASER_BUDGET),
+        ('enemy', lambda: Enemy(100, 100, 'red'), ENEMY_BUDGET),
+    ]
+    failed = False
+    for name, make, budget in checks:
+        size = bytes_per_object(make)
+        ok = size <= budget
+        failed |= not ok
+        print(f"{name}: {size:.0f} bytes per object (budget {budget}) "
+              f"{'ok' if ok else 'OVER BUDGET'}")
+    for name, cls, pool, args in (('laser', Laser, LASERS, (100, 100, laser)),
+                                  ('enemy', Enemy, ENEMIES,
+                                   (100, 100, 'red'))):
+        new = collections_per_wave(lambda: cls(*args), lambda objs: None)
+        pooled = collections_per_wave(lambda: pool.acquire(*args),
+                                      pool.release_all)
+        print(f"{name}: {new:.1f} gc runs per wave of 1000 without the "
+              f"pool, {pooled:.1f} with it")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+# server metrics in prometheus text format, served over a local http port or
+# a unix socket:
+#
+#   python server.py --metrics 9100
+#   curl -s localhost:9100/metrics
+#
+# byte and frame counters are plain integer adds and always kept. timing a
+# tick and its phases costs clock reads, so that only happens while someone
+# is reading: the first scrape turns it on, and it turns itself off again
+# IDLE_TIMEOUT seconds after the last one. histograms only cover the time
+# since timing was turned on.
+
+import time
+import bisect
+import asyncio
+import urllib.parse
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1)
+# the parts of a tick: applying queued inputs, game logic, collisions,
+# building and encoding the snapshots, handing them to the sockets
+PHASES = ('input', 'simulation', 'collision', 'serialize', 'send')
+IDLE_TIMEOUT = 300
+
+# whether ticks are being timed right now, checked once per tick
+enabled = False
+last_scrape = 0.0
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        # the exposition lines of this histogram, buckets are cumulative
+        total = 0
+        for bound, count in zip(BUCKETS + ('+Inf', ), self.counts):
+            total += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {total}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class TickMetrics:
+    # a room's tick durations, whole and per phase
+
+    def __init__(self):
+        self.tick = Histogram()
+        self.phases = {phase: Histogram() for phase in PHASES}
+
+    def record(self, duration, phases):
+        # phases: seconds per phase, in PHASES order
+        self.tick.observe(duration)
+        for phase, seconds in zip(PHASES, phases):
+            self.phases[phase].observe(seconds)
+
+
+def scraped():
+    global enabled, last_scrape
+    enabled = True
+    last_scrape = time.monotonic()
+
+
+def expire():
+    # stop timing when nobody has asked for a while
+    global enabled
+    if enabled and time.monotonic() - last_scrape > IDLE_TIMEOUT:
+        enabled = False
+
+
+def labelled(labels):
+    return ','.join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def render(rooms, connections, totals):
+    # rooms: (labels, TickMetrics, {entity kind: count}) per room
+    # connections: (labels, {counter: value}, queue depth) per connection
+    # totals: {gauge name: value} for the whole process
+    out = []
+    for name, value in totals.items():
+        out.append(f'# TYPE game_{name} gauge')
+        out.append(f'game_{name} {value}')
+
+    out.append('# HELP game_tick_seconds Time spent in one simulation tick.')
+    out.append('# TYPE game_tick_seconds histogram')
+    for labels, tick_metrics, entities in rooms:
+        out.extend(tick_metrics.tick.lines('game_tick_seconds',
+                                           labelled(labels)))
+    out.append('# HELP game_tick_phase_seconds Time spent in each part of a '
+               'tick.')
+    out.append('# TYPE game_tick_phase_seconds histogram')
+    for labels, tick_metrics, entities in rooms:
+        for phase, histogram in tick_metrics.phases.items():
+            out.extend(histogram.lines('game_tick_phase_seconds',
+                                       labelled({**labels, 'phase': phase})))
+    out.append('# HELP game_entities Entities in a room.')
+    out.append('# TYPE game_entities gauge')
+    for labels, tick_metrics, entities in rooms:
+        for kind, count in entities.items():
+            out.append(
+                f'game_entities{{{labelled({**labels, "kind": kind})}}} '
+                f'{count}')
+
+    counters = (('bytes', 'Bytes sent and received.'),
+                ('frames', 'Frames or datagrams sent and received.'))
+    for counter, help_text in counters:
+        out.append(f'# HELP game_connection_{counter}_total {help_text}')
+        out.append(f'# TYPE game_connection_{counter}_total counter')
+        for labels, values, depth in connections:
+            for direction in ('in', 'out'):
+                line_labels = labelled({**labels, 'direction': direction})
+                out.append(f'game_connection_{counter}_total{{{line_labels}}} '
+                           f'{values[f"{counter}_{direction}"]}')
+    out.append('# HELP game_connection_dropped_snapshots_total Snapshots '
+               'replaced before a slow socket took them.')
+    out.append('# TYPE game_connection_dropped_snapshots_total counter')
+    for labels, values, depth in connections:
+        out.append(f'game_connection_dropped_snapshots_total'
+                   f'{{{labelled(labels)}}} {values["dropped"]}')
+    out.append('# HELP game_connection_queue_depth Frames waiting for a '
+               'socket to drain.')
+    out.append('# TYPE game_connection_queue_depth gauge')
+    for labels, values, depth in connections:
+        out.append(f'game_connection_queue_depth{{{labelled(labels)}}} '
+                   f'{depth}')
+    out.append('')
+    return '\n'.join(out)
+
+
+async def serve(collect, port=None, path=None, host='127.0.0.1',
+                commands=None):
+    # a minimal http server answering GET /metrics with collect(), on
+    # host:port or a unix socket at path. commands maps other paths to a
+    # function taking the query parameters and returning the reply text
+    commands = commands or {}
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (
+                    b'\r\n', b'\n', b''):
+                pass
+        except (OSError, asyncio.TimeoutError):
+            writer.close()
+            return
+        parts = request.split()
+        if len(parts) < 2 or parts[0] != b'GET':
+            status, body = '405 Method Not Allowed', ''
+        else:
+            url = urllib.parse.urlsplit(parts[1].decode('latin-1'))
+            if url.path in ('/', '/metrics'):
+                scraped()
+                status, body = '200 OK', collect()
+            elif url.path in commands:
+                params = dict(urllib.parse.parse_qsl(url.query))
+                status, body = '200 OK', commands[url.path](params)
+            else:
+                status, body = '404 Not Found', ''
+        body = body.encode()
+        writer.write(
+            f'HTTP/1.0 {status}\r\n'
+            f'Content-Type: text/plain; version=0.0.4\r\n'
+            f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        try:
+            await writer.drain()
+        except OSError:
+            pass
+        writer.close()
+
+    if path is not None:
+        server = await asyncio.start_unix_server(handle, path)
+    else:
+        server = await asyncio.start_server(handle, host, port)
+    async with server:
+        while True:
+            await asyncio.sleep(60)
+            expire()
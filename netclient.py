@@ -0,0 +1,178 @@
+# the client's end of the connection, run off the render loop. a reader
+# thread decodes every snapshot as it arrives and applies it to its own copy
+# of the world, a writer thread sends the queued input packets. the render
+# loop only ever takes what has arrived and queues what it wants sent, so a
+# slow network never holds up a frame.
+#
+# with udp, snapshots and inputs go over a datagram socket as well (a
+# second reader thread) and tcp only carries the handshake, ready changes,
+# the disconnect and snapshots too big for a datagram.
+#
+# a spectator (watch set) never sends anything after its hello, it only
+# reads the room's snapshots over tcp
+
+import json
+import time
+import queue
+import socket
+import threading
+import collections
+
+import snapshots
+from protocol import (FrameReader, pack_input, pack_udp_inputs, send_frame,
+                      send_text, INPUT_READY, INPUT_DISCONNECT,
+                      REDUNDANT_INPUTS, MAX_DATAGRAM)
+
+# received states kept for the render loop, the oldest go first when it
+# falls behind
+STATE_QUEUE = 16
+# applied states kept as delta baselines, as many as the server keeps
+HISTORY = 64
+
+
+class NetworkClient:
+
+    def __init__(self, addr, use_udp=False, watch=None):
+        self.addr = addr
+        # None to play, 0 to watch any room, a room id to watch that one
+        self.watch = watch
+        self.sock = socket.create_connection(addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = FrameReader(self.sock)
+        self.use_udp = use_udp
+        self.udp = None
+        self.token = None
+        self.world = snapshots.new_state()
+        # applied states by tick, udp deltas may build on any of them
+        self.history = {}
+        self.lock = threading.Lock()
+        # last snapshot tick applied, None asks the server for a keyframe
+        self.ack = None
+        # (arrival time, state) for every snapshot applied, the states are
+        # copies the reader threads won't change anymore
+        self.states = collections.deque(maxlen=STATE_QUEUE)
+        self.outgoing = queue.Queue()
+        self.closed = False
+        self.threads = []
+
+    def handshake(self):
+        # blocking, before start(): returns the server's reply to hello
+        if self.watch is None:
+            send_text(self.sock, 'hello')
+        elif self.watch:
+            send_text(self.sock, f'watch {self.watch}')
+        else:
+            send_text(self.sock, 'watch')
+        reply = self.reader.read_json()
+        if 'error' in reply:
+            raise ConnectionError(reply['error'])
+        if self.use_udp and self.watch is None and 'udp_port' in reply:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.connect((self.addr[0], reply['udp_port']))
+            self.token = reply['token']
+        return reply
+
+    def start(self):
+        loops = [self.read_loop]
+        if self.watch is None:
+            loops.append(self.write_loop)
+        if self.udp is not None:
+            loops.append(self.udp_loop)
+        for target in loops:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def receive(self, msg, arrived):
+        # the server only sends what changed since a tick we have: the last
+        # one it sent over tcp, the last one we acked over udp. if we don't
+        # have it anymore ask for a keyframe
+        with self.lock:
+            tick = msg['tick']
+            if self.world['tick'] is not None and tick <= self.world['tick']:
+                return  # late or duplicate datagram
+            if msg['base'] is None:
+                base = snapshots.new_state()
+            else:
+                base = self.history.get(msg['base'])
+                if base is None:
+                    self.ack = None
+                    return
+            world = snapshots.apply(snapshots.copy_state(base), msg)
+            self.world = world
+            self.history[tick] = world
+            for old in [old for old in self.history if old <= tick - HISTORY]:
+                del self.history[old]
+            self.ack = tick
+            self.states.append((arrived, world))
+
+    def read_loop(self):
+        try:
+            while True:
+                msg = self.reader.read_json()
+                self.receive(msg, time.monotonic())
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.closed = True
+            self.outgoing.put(None)
+
+    def udp_loop(self):
+        # a lost datagram is simply never seen, the next one is a delta
+        # against what we acked and fills the gap
+        while not self.closed:
+            try:
+                datagram = self.udp.recv(MAX_DATAGRAM)
+            except OSError:
+                break
+            try:
+                msg = json.loads(datagram)
+            except ValueError:
+                continue
+            self.receive(msg, time.monotonic())
+
+    def write_loop(self):
+        recent = collections.deque(maxlen=REDUNDANT_INPUTS)
+        last_buttons = 0
+        while True:
+            item = self.outgoing.get()
+            if item is None:
+                break
+            buttons, seq = item
+            packet = pack_input(buttons, seq, time.time(), self.ack)
+            # without udp everything goes over tcp, with it only what must
+            # not get lost
+            reliable = (self.udp is None or buttons & INPUT_DISCONNECT or
+                        (buttons ^ last_buttons) & INPUT_READY)
+            last_buttons = buttons
+            try:
+                if self.udp is not None:
+                    recent.append(packet)
+                    self.udp.send(pack_udp_inputs(self.token, list(recent)))
+                if reliable:
+                    send_frame(self.sock, packet)
+            except OSError:
+                break
+        self.closed = True
+
+    def send_input(self, buttons, seq):
+        self.outgoing.put((buttons, seq))
+
+    def take_states(self):
+        # every (arrival time, state) received since the last call
+        states = []
+        while True:
+            try:
+                states.append(self.states.popleft())
+            except IndexError:
+                return states
+
+    def close(self):
+        self.outgoing.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        if self.udp is not None:
+            self.udp.close()
@@ -0,0 +1,265 @@
+# on-demand profiling of a running server, no restart needed. everything
+# runs on the event loop thread, so one profiler sees the simulation and
+# the networking alike:
+#
+#   kill -USR1 <pid>          cProfile for PROFILE_SECONDS -> .pstats
+#   kill -USR2 <pid>          tracemalloc baseline, the next one compares
+#                             with it and stops tracemalloc again
+#
+# with --workers, signal a worker to profile just that one, or the front
+# to have every worker do it
+#
+# and with --metrics, on the same local endpoint:
+#
+#   /profile?seconds=10               cProfile -> .pstats (python -m pstats)
+#   /profile?seconds=10&mode=sample   sampling profiler -> .folded stacks
+#                                     (flamegraph.pl, speedscope)
+#   /memory                           the same as SIGUSR2
+#   /memory?waves=1                   ... and one at every new wave, until
+#   /memory?stop=1                    stops tracemalloc and the waves
+#   /trace?on=1, /trace?on=0          trace spans -> chrome trace .json
+#                                     (chrome://tracing, perfetto)
+#
+# files go to profile_dir. while nothing is switched on this costs one
+# flag check per tick and per frame. tracemalloc makes every allocation
+# slower, ticks take many times as long while it runs
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import cProfile
+import tracemalloc
+import collections
+
+PROFILE_SECONDS = 10
+MAX_PROFILE_SECONDS = 300
+SAMPLE_INTERVAL = 0.002
+# frames of traceback kept per allocation, more costs more
+TRACE_FRAMES = 1
+# spans kept per trace, the rest are dropped
+MAX_EVENTS = 500000
+TOP_GROWTH = 10
+
+profile_dir = 'profiles'
+# a cProfile or sampling session running, only one at a time
+running = False
+# trace spans wanted, and the chrome trace events so far
+tracing = False
+events = []
+# a tracemalloc snapshot at every wave start, and the snapshot to compare
+# the next one with
+memory_waves = False
+last_snapshot = None
+
+
+def output_path(kind, extension):
+    os.makedirs(profile_dir, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    return os.path.join(profile_dir,
+                        f'{kind}-{os.getpid()}-{stamp}.{extension}')
+
+
+class Sampler:
+    # a statistical cpu profiler: SIGPROF interrupts the process every
+    # interval of cpu time and the stack it interrupted is counted, written
+    # as folded stacks ('outer;inner count' per line)
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} '
+                         f'({os.path.basename(code.co_filename)}:'
+                         f'{code.co_firstlineno})')
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def dump_stats(self, path):
+        with open(path, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f'{stack} {count}\n')
+
+
+def start_profile(seconds=PROFILE_SECONDS, mode='cprofile'):
+    # profiles the next seconds of this process, the file is written when
+    # they are over. returns the path it will have, or None when busy
+    global running
+    if running:
+        return None
+    seconds = min(max(seconds, 0.1), MAX_PROFILE_SECONDS)
+    if mode == 'sample':
+        profiler = Sampler()
+        path = output_path('sample', 'folded')
+    else:
+        profiler = cProfile.Profile()
+        path = output_path('profile', 'pstats')
+    running = True
+    profiler.enable()
+
+    def finish():
+        global running
+        profiler.disable()
+        profiler.dump_stats(path)
+        running = False
+        print(f"[PROFILE] {seconds:g}s written to {path}")
+
+    asyncio.get_running_loop().call_later(seconds, finish)
+    print(f"[PROFILE] {mode} for {seconds:g}s")
+    return path
+
+
+def memory_snapshot(label='manual'):
+    # the first call starts tracemalloc and takes a baseline, the next one
+    # writes the lines that grew most since then and stops it again, unless
+    # memory_waves keeps it running for a snapshot at every wave
+    global last_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    path = output_path(f'memory-{label}', 'snapshot')
+    snapshot.dump(path)
+    lines = [f"[MEMORY] {label}: {tracemalloc.get_traced_memory()[0]} bytes "
+             f"traced, snapshot in {path}"]
+    if last_snapshot is None:
+        last_snapshot = snapshot
+        lines.append("  tracemalloc running, the next snapshot compares")
+    else:
+        for stat in snapshot.compare_to(last_snapshot,
+                                        'lineno')[:TOP_GROWTH]:
+            lines.append(f"  {stat}")
+        last_snapshot = snapshot
+        if not memory_waves:
+            stop_memory()
+            lines.append("  tracemalloc stopped")
+    report = '\n'.join(lines)
+    print(report)
+    return report
+
+
+def stop_memory():
+    global memory_waves, last_snapshot
+    memory_waves = False
+    last_snapshot = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def wave_started(room, level):
+    # called by the rooms while memory_waves is on
+    memory_snapshot(f'room{room}-level{level}')
+
+
+def span(name, started, ended, tid, **args):
+    # a complete event, times from time.perf_counter()
+    if len(events) < MAX_EVENTS:
+        events.append({
+            'name': name,
+            'ph': 'X',
+            'ts': started * 1e6,
+            'dur': (ended - started) * 1e6,
+            'pid': os.getpid(),
+            'tid': tid,
+            'args': args
+        })
+
+
+def start_trace():
+    global tracing
+    events.clear()
+    tracing = True
+
+
+def stop_trace():
+    # writes what was traced, returns the path
+    global tracing
+    tracing = False
+    path = output_path('trace', 'json')
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': events}, file)
+    print(f"[TRACE] {len(events)} spans written to {path}")
+    events.clear()
+    return path
+
+
+def profile_command(params):
+    try:
+        seconds = float(params.get('seconds', PROFILE_SECONDS))
+    except ValueError:
+        return "seconds must be a number\n"
+    path = start_profile(seconds, params.get('mode', 'cprofile'))
+    if path is None:
+        return "a profile is already running\n"
+    return f"profiling, will write {path}\n"
+
+
+def memory_command(params):
+    global memory_waves
+    if params.get('stop', '0') not in ('0', 'off', 'false'):
+        stop_memory()
+        return "tracemalloc stopped\n"
+    if 'waves' in params:
+        memory_waves = params['waves'] not in ('0', 'off', 'false')
+    return memory_snapshot() + '\n'
+
+
+def trace_command(params):
+    on = params.get('on', '1') not in ('0', 'off', 'false')
+    if on and not tracing:
+        start_trace()
+        return "tracing\n"
+    if not on and tracing:
+        return f"trace written to {stop_trace()}\n"
+    return f"tracing is already {'on' if tracing else 'off'}\n"
+
+
+# the admin commands, by url path, for metrics.serve()
+COMMANDS = {
+    '/profile': profile_command,
+    '/memory': memory_command,
+    '/trace': trace_command
+}
+
+
+def install_signals():
+    # SIGUSR1 profiles, SIGUSR2 takes a memory snapshot (not on windows)
+    if sys.platform == 'win32':
+        return
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, start_profile)
+    loop.add_signal_handler(signal.SIGUSR2, memory_snapshot)
+
+
+def forward_signals(pids):
+    # the front of --workers runs no rooms, it passes both signals on to
+    # every worker instead
+    if sys.platform == 'win32':
+        return
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGUSR1, signal.SIGUSR2):
+        loop.add_signal_handler(signum, send_signal, signum, pids)
+
+
+def send_signal(signum, pids):
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,268 @@
+import json
+import socket
+import struct
+import asyncio
+
+# every frame on the wire is a 4 byte big-endian payload length followed by
+# the payload itself, so the other side knows exactly how many bytes to read
+HEADER = struct.Struct('!I')
+FORMAT = 'utf-8'
+MAX_FRAME = 16 * 1024 * 1024
+# kernel socket buffers of server connections, set explicitly so a slow
+# reader is noticed after a few snapshots, not after the os default
+SEND_BUFFER = 16 * 1024
+RECEIVE_BUFFER = 16 * 1024
+
+
+def send_frame(sock, payload):
+    # one syscall per frame: header and payload go out together
+    header = HEADER.pack(len(payload))
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(header + payload)
+        return
+    sent = sock.sendmsg((header, payload))
+    if sent < HEADER.size:
+        sock.sendall(header[sent:])
+        sock.sendall(payload)
+    elif sent < HEADER.size + len(payload):
+        sock.sendall(memoryview(payload)[sent - HEADER.size:])
+
+
+def send_text(sock, msg):
+    send_frame(sock, msg.encode(FORMAT))
+
+
+def encode_json(msg):
+    return json.dumps(msg).encode(FORMAT)
+
+
+def send_json(sock, msg):
+    send_frame(sock, encode_json(msg))
+
+
+class FrameReader:
+    # reads whole frames into a buffer that is reused between calls, the
+    # memoryview returned by read_frame() is only valid until the next read
+
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+    def recv_exact(self, n):
+        if n > len(self.buf):
+            # don't resize in place, a caller may still hold a view on it
+            self.buf = bytearray(max(n, 2 * len(self.buf)))
+            self.view = memoryview(self.buf)
+        view = self.view[:n]
+        got = 0
+        while got < n:
+            count = self.sock.recv_into(view[got:], n - got)
+            if not count:
+                raise ConnectionError("socket closed")
+            got += count
+        return view
+
+    def read_frame(self):
+        (length, ) = HEADER.unpack(self.recv_exact(HEADER.size))
+        if length > MAX_FRAME:
+            raise ConnectionError(f"frame too large ({length} bytes)")
+        return self.recv_exact(length)
+
+    def read_text(self):
+        return str(self.read_frame(), FORMAT)
+
+    def read_json(self):
+        return json.loads(self.read_text())
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    # asyncio counterpart of FrameReader: the event loop reads straight into
+    # one reusable bytearray and frame_received() gets called with a
+    # memoryview of every whole frame, only valid during that call.
+    #
+    # outgoing frames are either reliable (send_frame, always delivered, in
+    # order) or snapshots (send_latest). when the socket can't take more,
+    # reliable frames wait in a queue and only the newest snapshot is kept,
+    # each one it replaces counts as dropped. whatever waited goes out in
+    # one writelines() call when the socket drains
+
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first byte not handed out as a frame yet
+        self.end = 0  # end of the received bytes
+        self.transport = None
+        self.paused = False
+        self.reliable = []
+        self.latest = None  # (payload, tag) of the snapshot waiting
+        self.dropped = 0
+        # traffic so far, frames out only count once they are written
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET,
+                                                socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            RECEIVE_BUFFER)
+        # pause as soon as the kernel buffer is full and anything has to
+        # wait in asyncio's buffer, resume once that is written out
+        transport.set_write_buffer_limits(high=0)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def get_buffer(self, sizehint):
+        if self.end == len(self.buf):
+            pending = self.end - self.start
+            if self.start == 0:
+                # a single frame bigger than the buffer, make it bigger
+                buf = bytearray(2 * len(self.buf))
+                buf[:pending] = self.buf
+                self.buf = buf
+                self.view = memoryview(buf)
+            else:
+                self.buf[:pending] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        self.bytes_in += nbytes
+        while self.end - self.start >= HEADER.size:
+            (length, ) = HEADER.unpack_from(self.buf, self.start)
+            if length > MAX_FRAME:
+                self.transport.close()
+                return
+            begin = self.start + HEADER.size
+            if self.end - begin < length:
+                break
+            self.start = begin + length
+            self.frames_in += 1
+            self.frame_received(self.view[begin:self.start])
+            if self.transport.is_closing():
+                return
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def frame_received(self, frame):
+        pass
+
+    def send_frame(self, payload):
+        if self.paused:
+            self.reliable.append(payload)
+        else:
+            self.write(payload)
+
+    def write(self, payload):
+        self.bytes_out += HEADER.size + len(payload)
+        self.frames_out += 1
+        self.transport.writelines((HEADER.pack(len(payload)), payload))
+
+    def send_latest(self, payload, tag=None):
+        # a snapshot: when the socket is backed up it replaces the one
+        # waiting, latest_sent(tag) is called once it is really written
+        if self.paused or self.reliable:
+            if self.latest is not None:
+                self.dropped += 1
+            self.latest = (payload, tag)
+            return
+        self.write(payload)
+        self.latest_sent(tag)
+
+    def latest_sent(self, tag):
+        pass
+
+    def queue_depth(self):
+        # frames waiting for the socket to drain
+        return len(self.reliable) + (self.latest is not None)
+
+    def flush(self):
+        if self.transport is None or self.transport.is_closing():
+            return
+        parts = []
+        for payload in self.reliable:
+            parts.append(HEADER.pack(len(payload)))
+            parts.append(payload)
+        self.reliable = []
+        latest = self.latest
+        self.latest = None
+        if latest is not None:
+            parts.append(HEADER.pack(len(latest[0])))
+            parts.append(latest[0])
+        if parts:
+            self.bytes_out += sum(len(part) for part in parts)
+            self.frames_out += len(parts) // 2
+            self.transport.writelines(parts)
+        if latest is not None:
+            self.latest_sent(latest[1])
+
+    def send_json(self, msg):
+        self.send_frame(encode_json(msg))
+
+
+# input packet, sent by the client once per tick:
+# action bitmask, input sequence number, client timestamp and the last
+# snapshot tick the client applied (NO_ACK to ask for a keyframe)
+INPUT = struct.Struct('!BIdI')
+INPUT_LEFT = 1 << 0
+INPUT_RIGHT = 1 << 1
+INPUT_UP = 1 << 2
+INPUT_DOWN = 1 << 3
+INPUT_FIRE = 1 << 4
+INPUT_READY = 1 << 5
+INPUT_DISCONNECT = 1 << 6
+NO_ACK = 0xFFFFFFFF
+
+
+def pack_input(buttons, seq, timestamp, ack):
+    if ack is None:
+        ack = NO_ACK
+    return INPUT.pack(buttons, seq & 0xFFFFFFFF, timestamp, ack)
+
+
+def unpack_input(buf):
+    buttons, seq, timestamp, ack = INPUT.unpack(buf)
+    if ack == NO_ACK:
+        ack = None
+    return buttons, seq, timestamp, ack
+
+
+# optional udp channel, for what only needs to arrive fast: snapshots and
+# inputs. a snapshot datagram is the snapshot's json, without a header. an
+# input datagram is the connection's token (from the join reply) and the
+# last few input packets, oldest first, so a lost datagram is covered by the
+# next one
+UDP_INPUTS = struct.Struct('!IB')
+REDUNDANT_INPUTS = 4
+# the most a udp datagram can hold over ipv4
+MAX_DATAGRAM = 65507
+
+
+def pack_udp_inputs(token, packets):
+    return UDP_INPUTS.pack(token, len(packets)) + b''.join(packets)
+
+
+def unpack_udp_inputs(buf):
+    # (token, [input tuples]), ValueError when the datagram is malformed
+    if len(buf) < UDP_INPUTS.size:
+        raise ValueError("short datagram")
+    token, count = UDP_INPUTS.unpack_from(buf)
+    if len(buf) != UDP_INPUTS.size + count * INPUT.size:
+        raise ValueError("bad input count")
+    inputs = []
+    for offset in range(UDP_INPUTS.size, len(buf), INPUT.size):
+        inputs.append(unpack_input(buf[offset:offset + INPUT.size]))
+    return token, inputs
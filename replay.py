@@ -0,0 +1,192 @@
+# match recording and replay. a room's simulation only depends on its seed
+# and on what happened at the start of each tick (joins, leaves and the
+# buttons applied), so that is all a recording holds, plus a checksum of the
+# world every so often. replaying runs the same simulation headless as fast
+# as it goes and checks it ends up in the same states:
+#
+#   python server.py --record recordings
+#   python replay.py recordings/room-1-1760000000.rec [--arrays] [--repeat 5]
+#
+# exits with 1 when a checksum differs, so a recording doubles as a
+# regression test, and the ticks per second it prints as a benchmark of the
+# simulation on a real match
+#
+# file layout, big-endian: a header, then records of a one byte tag and its
+# fields. the buttons of a tick come after the joins and leaves it applied
+
+import sys
+import json
+import time
+import zlib
+import struct
+import argparse
+
+from simulation import Simulation, SPAWN
+
+MAGIC = b'SSRP'
+VERSION = 4
+# magic, version, tick rate, seed, ticks between checksums, view margin (the
+# checksums are of what the players were sent)
+HEADER = struct.Struct('!4sBHQHH')
+TAG = struct.Struct('!B')
+JOIN, LEAVE, TICK, CHECKSUM, SEQ = range(5)
+RECORDS = {
+    JOIN: struct.Struct('!B'),  # slot
+    LEAVE: struct.Struct('!B'),  # slot
+    # buttons of slot 1 and 2, and how far the seq of the input each applied
+    # moved on since the last tick (ships move by it, see rules.per_tick)
+    TICK: struct.Struct('!BBBB'),
+    CHECKSUM: struct.Struct('!II'),  # tick, crc32 of the world after it
+    # slot, seq: written before a tick whose seq moved back or too far on
+    # for a byte, its tick then moves that slot's seq by 0
+    SEQ: struct.Struct('!BI'),
+}
+COMMANDS = {'join': JOIN, 'leave': LEAVE}
+CHECKSUM_INTERVAL = 60
+
+# data fields that don't change how the match plays: addresses and input
+# sequence numbers differ between the live match and its replay
+IGNORED = ('user1', 'user2', 'seq1', 'seq2')
+
+
+def state_checksum(state):
+    # what the players see of a world state. entity ids come from a counter
+    # all rooms of a process share, so only the order of entities counts
+    data = state['data']
+    world = [[(key, data[key]) for key in sorted(data) if key not in IGNORED],
+             [list(fields.values()) for fields in state['enemies'].values()]]
+    for slot in SPAWN:
+        lasers = state[f'lasers{slot}']
+        world.append([list(fields.values()) for fields in lasers.values()])
+    return zlib.crc32(json.dumps(world).encode())
+
+
+class Recorder:
+    # set as simulation.recorder, the simulation calls command() for every
+    # join and leave and stepped() after every tick
+
+    def __init__(self, file, simulation, interval=CHECKSUM_INTERVAL):
+        self.file = file
+        self.interval = interval
+        self.seqs = {1: 0, 2: 0}
+        file.write(
+            HEADER.pack(MAGIC, VERSION, simulation.tick_rate, simulation.seed,
+                        interval, simulation.view_margin))
+
+    def write(self, tag, *fields):
+        self.file.write(TAG.pack(tag) + RECORDS[tag].pack(*fields))
+
+    def command(self, kind, slot):
+        self.write(COMMANDS[kind], slot)
+
+    def stepped(self, simulation):
+        buttons = simulation.buttons
+        moved = []
+        for slot, last in self.seqs.items():
+            seq = simulation.data[f'seq{slot}']
+            if not 0 <= seq - last <= 255:
+                self.write(SEQ, slot, seq)
+                last = seq
+            moved.append(seq - last)
+            self.seqs[slot] = seq
+        self.write(TICK, buttons.get(1, 0), buttons.get(2, 0), *moved)
+        if simulation.tick % self.interval == 0:
+            self.write(CHECKSUM, simulation.tick,
+                       state_checksum(simulation.state))
+
+    def close(self):
+        self.file.close()
+
+
+def read_header(data):
+    magic, version, tick_rate, seed, interval, view_margin = (
+        HEADER.unpack_from(data))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a recording, or from another version")
+    return tick_rate, seed, interval, view_margin
+
+
+def read_records(data, offset=HEADER.size):
+    # (tag, fields) of every record after the header. a server that was
+    # killed may have left half a record at the end, it is skipped
+    while offset < len(data):
+        (tag, ) = TAG.unpack_from(data, offset)
+        record = RECORDS.get(tag)
+        if record is None:
+            raise ValueError(f"unknown record {tag} at byte {offset}")
+        offset += TAG.size
+        if offset + record.size > len(data):
+            return
+        yield tag, record.unpack_from(data, offset)
+        offset += record.size
+
+
+def replay(data, simulation_class=Simulation):
+    # plays a recording again, returns (ticks, seconds stepping, checksums
+    # compared, first tick whose checksum differs or None)
+    tick_rate, seed, interval, view_margin = read_header(data)
+    simulation = simulation_class(tick_rate, seed, view_margin)
+    present = set()
+    seqs = {1: 0, 2: 0}
+    ticks = compared = 0
+    busy = 0.0
+    for tag, fields in read_records(data):
+        if tag == JOIN:
+            present.add(fields[0])
+            simulation.submit('join', fields[0], ('replay', fields[0]))
+        elif tag == LEAVE:
+            present.discard(fields[0])
+            simulation.submit('leave', fields[0])
+        elif tag == SEQ:
+            seqs[fields[0]] = fields[1]
+        elif tag == TICK:
+            for slot in seqs:
+                seqs[slot] += fields[slot + 1]
+            # one input per player, applied on this very tick
+            for slot in present:
+                simulation.submit('input', slot, fields[slot - 1],
+                                  seqs[slot])
+            started = time.perf_counter()
+            simulation.step()
+            busy += time.perf_counter() - started
+            ticks += 1
+        elif tag == CHECKSUM:
+            tick, checksum = fields
+            compared += 1
+            if (simulation.tick != tick or
+                    state_checksum(simulation.state) != checksum):
+                return ticks, busy, compared, tick
+    return ticks, busy, compared, None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording')
+    parser.add_argument('--arrays',
+                        action='store_true',
+                        help="replay with the numpy enemy storage")
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help="replay this many times, for steadier timings")
+    args = parser.parse_args()
+    simulation_class = Simulation
+    if args.arrays:
+        from entity_arrays import ArraySimulation
+        simulation_class = ArraySimulation
+    with open(args.recording, 'rb') as file:
+        data = file.read()
+    for run in range(args.repeat):
+        ticks, busy, compared, bad = replay(data, simulation_class)
+        if bad is not None:
+            print(f"checksum mismatch at tick {bad}, {compared} checksums in")
+            return 1
+        rate = ticks / busy if busy else 0.0
+        print(f"{ticks} ticks in {busy:.3f}s ({rate:.0f} ticks/s, "
+              f"{busy / max(ticks, 1) * 1e6:.0f} us per tick), "
+              f"{compared} checksums ok")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
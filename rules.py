@@ -0,0 +1,38 @@
+# the gameplay rules both sides need: the server's simulation runs them for
+# real and the client runs the player movement ahead of the server to
+# predict its own ship. nothing in here may load images or touch pygame
+
+from protocol import INPUT_LEFT, INPUT_RIGHT, INPUT_UP, INPUT_DOWN
+
+WIDTH, HEIGHT = 750, 750
+
+# speeds are in pixels per second and the laser cooldown in seconds, the
+# simulation turns them into per tick values for its tick rate
+PLAYER_SPEED = 200
+ENEMY_SPEED = 140
+LASER_SPEED = 600
+COOLDOWN_TIME = 1 / 3
+
+
+def per_tick(speed, tick_rate, count):
+    # whole pixels to move on the count'th tick at speed pixels per second.
+    # positions stay whole pixels and the remainder carries over to the
+    # next ticks, so any count ticks in a row cover speed * count / tick_rate
+    # pixels (give or take one) at every tick rate. nothing moves before
+    # the first tick
+    if count <= 0:
+        return 0
+    return speed * count // tick_rate - speed * (count - 1) // tick_rate
+
+
+def move_player(x, y, buttons, vel, width, height):
+    # where a width x height ship at x, y ends up after one tick of buttons
+    if buttons & INPUT_LEFT and x - vel > 0:  # left
+        x -= vel
+    if buttons & INPUT_RIGHT and x + vel + width < WIDTH:  # right
+        x += vel
+    if buttons & INPUT_UP and y - vel > 0:  # up
+        y -= vel
+    if buttons & INPUT_DOWN and y + vel + height + 15 < HEIGHT:  # down
+        y += vel
+    return x, y
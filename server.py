@@ -1,603 +1,817 @@
-import socket
-import threading
-import json
-import pygame
 import os
 import time
-import random
-
-pygame.font.init()
-
-flag = False
-WIDTH, HEIGHT = 750, 750
-WIN = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Space Shooter Tutorial")
-
-# Load images
-RED_SPACE_SHIP = pygame.image.load(
-    os.path.join("assets", "pixel_ship_red_small.png"))
-GREEN_SPACE_SHIP = pygame.image.load(
-    os.path.join("assets", "pixel_ship_green_small.png"))
-BLUE_SPACE_SHIP = pygame.image.load(
-    os.path.join("assets", "pixel_ship_blue_small.png"))
-
-# Player player
-YELLOW_SPACE_SHIP = pygame.image.load(
-    os.path.join("assets", "pixel_ship_yellow.png"))
-
-# Lasers
-RED_LASER = pygame.image.load(os.path.join("assets", "pixel_laser_red.png"))
-GREEN_LASER = pygame.image.load(os.path.join("assets",
-                                             "pixel_laser_green.png"))
-BLUE_LASER = pygame.image.load(os.path.join("assets", "pixel_laser_blue.png"))
-YELLOW_LASER = pygame.image.load(
-    os.path.join("assets", "pixel_laser_yellow.png"))
-
-# Background
-BG = pygame.transform.scale(
-    pygame.image.load(os.path.join("assets", "background-black.png")),
-    (WIDTH, HEIGHT))
-
-# data1 = {'x':0, 'y':0, 'health': 0,'x_e':0, 'y_e':0, 'health_e': 0}
-# data2 = {'x':0, 'y':0, 'health': 0,'x_e':0, 'y_e':0, 'health_e': 0}
-ready_players = 0
+import socket
+import struct
+import asyncio
+import secrets
+import argparse
+import functools
+import itertools
+import collections
+import multiprocessing
+
+import metrics
+import profiling
+from simulation import Simulation, VIEW_MARGIN
+from replay import Recorder
+from protocol import (FrameProtocol, FORMAT, HEADER, unpack_input,
+                      unpack_udp_inputs, INPUT_DISCONNECT, MAX_DATAGRAM)
+
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+try:
+    from entity_arrays import ArraySimulation
+except ImportError:  # numpy is optional, only needed for --arrays
+    ArraySimulation = None
+
+TICK_RATE = 60
+MAX_ROOMS = 500
+WORKERS = 0
+tick_rate = TICK_RATE
+max_rooms = MAX_ROOMS
+# Simulation, or ArraySimulation with --arrays
+simulation_class = Simulation
+# snapshots and inputs over udp as well, --udp
+use_udp = False
+# snapshots per second sent to spectators, None for every tick
+spectator_rate = None
+# pixels around the screen whose enemies are still sent, --view-margin
+view_margin = VIEW_MARGIN
+# directory every room's match gets recorded to, --record
+record_dir = None
+# where metrics are served, --metrics / --metrics-socket (workers: port + i,
+# path.i)
+metrics_port = None
+metrics_path = None
 user_count = 0
-enemies = []
-data = {
-    'ready': False,
-    'level': 0,
-    'user1': '0.0.0.0',
-    'user2': '0.0.0.0',
-    'x1': 0,
-    'y1': 0,
-    'health1': 100,
-    'lost1': False,
-    'x2': 0,
-    'y2': 0,
-    'health2': 100,
-    'lost2': False,
-    'win1': False,
-    'win2': False
-}
-wave_length = 10
-enemy_vel = 4
-level = 0
-
-HEADER = 64
+# every open client connection
+connections = set()
+rooms = set()
+# rooms with a free player slot, in the order they opened up
+open_rooms = {}
+# greeted connections waiting for a room, they get their hello answered once
+# they are given a slot in one
+lobby = collections.deque()
+# spectators that asked for any room while none was running
+watchers = collections.deque()
+# with --udp: the datagram transport of this process, the port it listens on
+# and the connections by the token their datagrams carry
+udp = None
+udp_port = None
+udp_tokens = {}
+
+REPORT_INTERVAL = 10
+
 PORT = 5050
 # SERVER = "192.168.43.1"
 SERVER = socket.gethostbyname(socket.gethostname())
 ADDR = (SERVER, PORT)
-FORMAT = 'utf-8'
-DEISCONNECT_MESSAGE = '!DISCONNECT'
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind(ADDR)
-
-a = []
-i = 0
-
-
-# i used this protocl so the client from the other side konws how many bites that are needed to receive
-def send_dict(msg, conn):
-    msg_str = json.dumps(msg)
-    message = msg_str.encode(FORMAT)
-    msg_length = len(message)
-    send_length = str(msg_length).encode(FORMAT)
-    send_length += b' ' * (HEADER - len(send_length))
-    conn.send(send_length)
-    conn.send(message)
-    #print(client.recv(2048).decode(FORMAT))
-
-
-def send(msg, conn):
-    message = msg.encode(FORMAT)
-    msg_length = len(message)
-    send_length = str(msg_length).encode(FORMAT)
-    send_length += b' ' * (HEADER - len(send_length))
-    conn.send(send_length)
-    conn.send(message)
-    #print(client.recv(2048).decode(FORMAT))
-
-
-semaphore = threading.Semaphore()
-semaphore2 = threading.Semaphore()
-semaphore3 = threading.Semaphore()
-semaphore4 = threading.Semaphore()
-semaphore5 = threading.Semaphore()
-semaphore6 = threading.Semaphore()
-semaphore7 = threading.Semaphore()
-semaphore8 = threading.Semaphore()
-semaphore9 = threading.Semaphore()
-semaphore10 = threading.Semaphore()
-
-
-class Laser:
-
-    def __init__(self, x, y, img):
-        self.x = x
-        self.y = y
-        self.img = img
-        self.mask = pygame.mask.from_surface(self.img)
-
-    def draw(self, window):
-        window.blit(self.img, (self.x, self.y))
-
-    def move(self, vel):
-        self.y += vel
-
-    def off_screen(self, height):
-        return not (self.y <= height and self.y >= 0)
-
-    def collision(self, obj):
-        return collide(self, obj)
-
-
-class Ship:
-    COOLDOWN = 20
-
-    def __init__(self, x, y, health=100):
-        self.x = x
-        self.y = y
-        self.health = health
-        self.ship_img = None
-        self.laser_img = None
-        self.lasers = []
-        self.cool_down_counter = 0
-
-    def draw(self, window):
-        window.blit(self.ship_img, (self.x, self.y))
-        for laser in self.lasers:
-            laser.draw(window)
-
-    def move_lasers(self, vel, obj):
-        self.cooldown()
-        for laser in self.lasers:
-            laser.move(vel)
-            if laser.off_screen(HEIGHT):
-                self.lasers.remove(laser)
-            elif laser.collision(obj):
-                obj.health -= 10
-                self.lasers.remove(laser)
-
-    def cooldown(self):
-        if self.cool_down_counter >= self.COOLDOWN:
-            self.cool_down_counter = 0
-        elif self.cool_down_counter > 0:
-            self.cool_down_counter += 1
-
-    def shoot(self):
-        if self.cool_down_counter == 0:
-            laser = Laser(self.x, self.y, self.laser_img)
-            self.lasers.append(laser)
-            self.cool_down_counter = 1
-
-    def get_width(self):
-        return self.ship_img.get_width()
-
-    def get_height(self):
-        return self.ship_img.get_height()
-
-
-class Player(Ship):
-
-    def __init__(
-        self,
-        x,
-        y,
-        health=100,
-    ):
-        super().__init__(
-            x,
-            y,
-            health,
-        )
-        self.ship_img = YELLOW_SPACE_SHIP
-        self.laser_img = YELLOW_LASER
-        self.mask = pygame.mask.from_surface(self.ship_img)
-        self.max_health = health
-
-    def move_lasers(self, vel, objs):
-        self.cooldown()
-        for laser in self.lasers:
-            laser.move(vel)
-            if laser.off_screen(HEIGHT):
-                self.lasers.remove(laser)
-            else:
-                for obj in objs:
-                    if laser.collision(obj):
-                        objs.remove(obj)
-                        if laser in self.lasers:
-                            self.lasers.remove(laser)
-
-    def draw(self, window):
-        super().draw(window)
-        #self.healthbar(window)
-
-    def healthbar(self, window):
-        pygame.draw.rect(window, (255, 0, 0),
-                         (self.x, self.y + self.ship_img.get_height() + 10,
-                          self.ship_img.get_width(), 10))
-        pygame.draw.rect(window, (0, 255, 0),
-                         (self.x, self.y + self.ship_img.get_height() + 10,
-                          self.ship_img.get_width() *
-                          (self.health / self.max_health), 10))
-
-
-class Enemy(Ship):
-    COLOR_MAP = {
-        "red": (RED_SPACE_SHIP, RED_LASER),
-        "green": (GREEN_SPACE_SHIP, GREEN_LASER),
-        "blue": (BLUE_SPACE_SHIP, BLUE_LASER)
-    }
 
-    def __init__(self, x, y, color, health=100):
-        super().__init__(x, y, health)
-        self.ship_img, self.laser_img = self.COLOR_MAP[color]
-        self.mask = pygame.mask.from_surface(self.ship_img)
-
-    def move(self, vel):
-        self.y += vel
-
-    def shoot(self):
-        if self.cool_down_counter == 0:
-            laser = Laser(self.x - 20, self.y, self.laser_img)
-            self.lasers.append(laser)
-            self.cool_down_counter = 1
-
-
-def collide(obj1, obj2):
-    offset_x = obj2.x - obj1.x
-    offset_y = obj2.y - obj1.y
-    return obj1.mask.overlap(obj2.mask, (offset_x, offset_y)) != None
-
-
-laysers_data = []
-lasers_data2 = []
-ready = False
-flag8 = False
-flag9 = False
-
-user1_ready = False
-user2_ready = False
-
-
-def handle_client_disconnect(conn, addr):
-    global user_count
-    global enemies
-    global level
-    global enemy_vel
-    global wave_length
-
-    data['win1'] = False
-    data['win2'] = False
-    with semaphore10:
-        enemies = []
-        with semaphore4:
-            user_count -= 1
-        level = 0
-        enemy_vel = 0
-        wave_length = 10
-        data['lost1'] = False
-        data['lost2'] = False
-    if addr == data['user1']:
-        data['user1'] = '0.0.0.0'
-        data['lost1'] = False
-        data['health1'] = 100
-        conn.close()
-    elif addr == data['user2']:
-        data['user2'] = '0.0.0.0'
-        data['lost2'] = False
-        data['health2'] = 100
-        conn.close()
-    else:
-        conn.close()
-    quit()
-
-
-flag5 = False
-
-
-def handle_client(conn, addr):
-    
-    print("[NEW CONNECTION] {addr} connected.")
-    global semaphore, semaphore2, semaphore3, semaphore4, semaphore5, semaphore6, semaphore7
-    global user1_ready
-    global user2_ready
-    global ready
-    global lasers_data
-    global lasers_data2
-    global i
-    global ready_players
-    global user_count
-    global enemies
-    global wave_length
-    global enemy_vel
-    global level
-    global flag
-    global flag8
-    global flag5
-    global flag9
-    run = True
-    FPS = 60
-
-    player_vel = 10
-    laser_vel = 10
-
-    # player2_vel = 5
-    # laser_vel = 5
-    if addr == data['user1']:
-        player = Player(220, 630)
-    if addr == data['user2']:
-        player = Player(400, 630)
-    # player2 = Player(350, 630)
-
-    clock = pygame.time.Clock()
-
-    lost = False
-    lost_count = 0
-
-    msg_length = conn.recv(HEADER).decode(FORMAT)
-
-    if msg_length:
-        msg_length = int(msg_length)
-        ready_msg = conn.recv(msg_length).decode(FORMAT)
-        if ready_msg == 'hello':
-            addr_dict = {"ip": addr[0], "port": addr[1]}
-            # addr_str = json.dumps(addr_dict)
-            # conn.send(addr_str.encode(FORMAT))
-            send_dict(addr_dict, conn)
-
-    time2 = 2.0
-    time1 = 2.0
-
-    while run:
-        pygame.event.pump()
-        clock.tick(FPS)
 
-        while True:
-            try:
-                msg_length = conn.recv(HEADER).decode(FORMAT)
-                if msg_length:
-                    msg_length = int(msg_length)
-                    msg = conn.recv(msg_length).decode(FORMAT)
-                    if msg == DEISCONNECT_MESSAGE:
-                        #msg_dict = json.loads(msg)
-                        break
-                    else:
-                        user_data = json.loads(msg)
-                        break
-            except Exception:
-                handle_client_disconnect(conn, addr)
-
-        if addr == data['user1']:
-            user1_ready = user_data['ready']
-            if user_data['connection'] == False:
-                handle_client_disconnect(conn, addr)
-        elif addr == data['user2']:
-            user2_ready = user_data['ready']
-            if user_data['connection'] == False:
-                handle_client_disconnect(conn, addr)
-            #print(user_data)
-
-        if user1_ready and user2_ready:
-            if not data['ready']:
-                enemies = []
-                if addr == data['user1']:
-                    player = Player(220, 630)
-                if addr == data['user2']:
-                    player = Player(400, 630)
-
-            data['ready'] = True
-            user1_ready = False  # baraye nobat dehi bar haye ba'di bayad False konimeshoon ke darja naran too
-            user2_ready = False
-            data['lost1'] = False
-            data['lost2'] = False
-            data['win1'] = False
-            data['win2'] = False
-
-        if not data['ready']:
-            level = 0
-            #enemies = []
-            enemy_vel = 0
-            player_vel = 0
-            wave_length = 10
-            data['lost1'] = False
-            data['lost2'] = False
-
-        elif data['user1'] == '0.0.0.0' or data['user2'] == '0.0.0.0' or data[
-                'lost1'] or data['lost2']:
-            with semaphore8:  # reset everything in case of lost of one of the player
-                flag8 = not flag8
-                if (flag8):
-                    data['lost1'] = False
-                    data['lost2'] = False
-                    data['ready'] = False
-
-                    level = 0
-                    enemy = []
-                    enemy_vel = 0
-                    player_vel = 0
-                    wave_length = 10
-                    user_data['ready'] = False
-            if addr == data['user1']:
-                player = Player(220, 630)
-            if addr == data['user2']:
-                player = Player(400, 630)
-
-        # enemy_vel = int(80.0 * (time2-time1))
-        # player_vel = int(550.0 * (time2-time1))
+class Room:
+    # one match: its own simulation (players, enemies, level and waves),
+    # ticking as its own task on the event loop, and the connections
+    # playing in it
+    ids = itertools.count(1)
+
+    def __init__(self, tick_rate):
+        self.id = next(self.ids)
+        self.players = {1: None, 2: None}
+        # read-only connections, they get every spectator_interval'th
+        # snapshot and never send input
+        self.spectators = set()
+        if spectator_rate is None:
+            self.spectator_interval = 1
         else:
-            # enemy_vel = 4
-            # player_vel = 10
-            enemy_vel = int(140.0 * (time2 - time1))
-            player_vel = int(200.0 * (time2 - time1))
-        # redraw_window()
-
-        time1 = time.time()
-        # if lives <= 0 or player.health <= 0:
-        if addr == data['user1'] and player.health <= 0:
-            data['lost1'] = True
-            data['win2'] = True
-            lost_count += 1
-
-        if addr == data['user2'] and player.health <= 0:
-            data['lost2'] = True
-            data['win1'] = True
-            lost_count += 1
-
-        with semaphore2:
-            flag5 = not (flag5)
-            if flag5:
-                if len(enemies) == 0:
-                    level += 1
-                    wave_length += 10
-                    for i in range(wave_length):
-                        enemy = Enemy(random.randrange(50, WIDTH - 100),
-                                      random.randrange(-1500, -100),
-                                      random.choice(["red", "blue", "green"]))
-                        enemies.append(enemy)
-
-        while True:
-            try:
-                msg_length = conn.recv(HEADER).decode(FORMAT)
-                if msg_length:
-                    msg_length = int(msg_length)
-                    msg = conn.recv(msg_length).decode(FORMAT)
-                    if msg == DEISCONNECT_MESSAGE:
-                        #msg_dict = json.loads(msg)
-                        break
-                    else:
-                        keys = json.loads(msg)
-                        break
-            except Exception:
-                handle_client_disconnect(conn, addr)
-
-        #keys = pygame.key.get_pressed()
-        #player.x -= player_vel
-        # for i in range(0, len(keys)):
-        #     if keys[i]:
-        #         print(i)
-
-        if keys[(pygame.K_a) - 93] and player.x - player_vel > 0:  # left
-            player.x -= player_vel
-        if keys[pygame.K_d - 93] and player.x + player_vel + player.get_width(
-        ) < WIDTH:  # right
-            player.x += player_vel
-        if keys[pygame.K_w - 93] and player.y - player_vel > 0:  # up
-            player.y -= player_vel
-        if keys[pygame.K_s - 93] and player.y + player_vel + player.get_height(
-        ) + 15 < HEIGHT:  # down
-            player.y += player_vel
-        if keys[pygame.K_SPACE + 12]:
-            player.shoot()
-            # print("hello")
-
-        with semaphore2:
-            flag = not flag
-            if flag:
-                for enemy in enemies[:]:
-                    enemy.move(enemy_vel)
-                    # enemy.move_lasers(laser_vel, player)
-
-                    # if random.randrange(0, 2*60) == 1:
-                    #     enemy.shoot()
-
-                    if collide(enemy, player):
-                        player.health -= 10
-                        enemies.remove(enemy)
-                    elif enemy.y + enemy.get_height() > HEIGHT:
-                        #     lives -= 1
-                        enemies.remove(enemy)
-
-            player.move_lasers(-laser_vel, enemies)
-
-        #connected = True
-
-        data["level"] = level
-
-        if addr == data["user1"]:
-            data["x1"] = player.x
-            data["y1"] = player.y
-            data["health1"] = player.health
-
-        elif addr == data["user2"]:
-            data["x2"] = player.x
-            data["y2"] = player.y
-            data["health2"] = player.health
-
-        # data_str = json.dumps(data)
-        # conn.send(data_str.encode(FORMAT))
-        send_dict(data, conn)
-
-        if addr == data["user1"]:
-            with semaphore5:
-                lasers_data = []
-                for laser in player.lasers:
-                    lasers_data.append({'x': laser.x, 'y': laser.y})
-                #print(lasers_data)
-
-                #conn.send("hello".encode(FORMAT))
-        elif addr == data["user2"]:
-            with semaphore6:
-                lasers_data2 = []
-                for laser in player.lasers:
-                    lasers_data2.append({'x': laser.x, 'y': laser.y})
-
-            #print(lasers_data)
-
-        lasers_data_str = json.dumps(lasers_data)
-        send(lasers_data_str, conn)
-        # conn.send(lasers_data_str.encode(FORMAT))
-
-        lasers_data_str2 = json.dumps(lasers_data2)
-        send(lasers_data_str2, conn)
-
-        enemies_data = []
-        for i in range(len(enemies)):
-            if enemies[i].ship_img == RED_SPACE_SHIP:
-                color = "red"
-            elif enemies[i].ship_img == GREEN_SPACE_SHIP:
-                color = "green"
+            self.spectator_interval = max(1, round(tick_rate / spectator_rate))
+        self.simulation = simulation_class(tick_rate, view_margin=view_margin)
+        self.simulation.listeners.append(self.send_snapshots)
+        self.simulation.metrics = metrics.TickMetrics()
+        self.simulation.room = self.id
+        self.level = self.simulation.level
+        if record_dir is not None:
+            path = os.path.join(record_dir,
+                                f"room-{self.id}-{int(time.time())}.rec")
+            self.simulation.recorder = Recorder(open(path, 'wb'),
+                                                self.simulation)
+        self.task = asyncio.get_running_loop().create_task(
+            self.simulation.run())
+
+    def free_slot(self):
+        for slot, conn in self.players.items():
+            if conn is None:
+                return slot
+
+    def empty(self):
+        return all(conn is None for conn in self.players.values())
+
+    def join(self, conn):
+        slot = self.free_slot()
+        conn.room = self
+        conn.slot = slot
+        self.players[slot] = conn
+        addr_dict = {
+            "ip": conn.addr[0],
+            "port": conn.addr[1],
+            "tick_rate": self.simulation.tick_rate
+        }
+        if udp is not None:
+            conn.token = new_token()
+            udp_tokens[conn.token] = conn
+            addr_dict["udp_port"] = udp_port
+            addr_dict["token"] = conn.token
+        conn.send_json(addr_dict)
+        self.simulation.submit('join', slot, conn.addr)
+
+    def leave(self, conn):
+        self.simulation.submit('leave', conn.slot)
+        self.players[conn.slot] = None
+
+    def watch(self, conn):
+        conn.room = self
+        self.spectators.add(conn)
+        conn.send_json({
+            "ip": conn.addr[0],
+            "port": conn.addr[1],
+            "tick_rate": self.simulation.tick_rate,
+            "room": self.id,
+            "spectator": True,
+            "snapshot_rate": self.simulation.tick_rate / self.spectator_interval
+        })
+
+    def unwatch(self, conn):
+        self.spectators.discard(conn)
+        conn.room = None
+
+    def close(self):
+        self.simulation.stop()
+        if self.simulation.recorder is not None:
+            self.simulation.recorder.close()
+        # the match is over, so is watching it
+        for conn in list(self.spectators):
+            self.unwatch(conn)
+            conn.transport.close()
+
+    def send_snapshots(self, simulation):
+        # every player gets every tick's snapshot, whether it sent input or
+        # not. delta frames are cached per baseline. tcp delivers every frame
+        # in order, so the next delta can build on the tick we just sent
+        # without waiting for the client to ack it. over udp any snapshot can
+        # get lost, so deltas build on the tick the client acked
+        if self.level != simulation.level:
+            self.level = simulation.level
+            if profiling.memory_waves:
+                profiling.wave_started(self.id, self.level)
+        for conn in self.players.values():
+            if conn is None:
+                continue
+            frame = simulation.snapshot_frame(conn.acked)
+            if conn.udp_addr is not None and len(frame) <= MAX_DATAGRAM:
+                udp.sendto(frame, conn.udp_addr)
+                conn.bytes_out += len(frame)
+                conn.frames_out += 1
             else:
-                color = "blue"
-
-            enemies_data.append({
-                'ex': enemies[i].x,
-                'ey': enemies[i].y,
-                'ecolor': color
-            })
+                # a slow reader keeps at most one snapshot waiting, the
+                # newest, and it builds on the last one really written
+                conn.send_latest(frame, simulation.tick)
+        if not self.spectators or simulation.tick % self.spectator_interval:
+            return
+        # spectators that kept up all have the same baseline, one encoded
+        # frame goes to all of them. only one that fell behind costs another
+        # encode, shared with everyone behind by as much
+        for conn in self.spectators:
+            conn.send_latest(simulation.snapshot_frame(conn.acked),
+                             simulation.tick)
+
+
+class Connection(FrameProtocol):
+    # one per client socket, everything runs on the event loop so nothing
+    # here ever blocks: frames come in through frame_received() and
+    # snapshots go out from Room.send_snapshots() every tick
+
+    def __init__(self, hello=None):
+        super().__init__()
+        # the hello the front process already read, with --workers
+        self.hello = hello
+        self.addr = None
+        self.room = None
+        self.slot = None
+        self.spectator = False
+        self.greeted = False
+        self.acked = None
+        # newest input seq seen, inputs can come twice with udp
+        self.last_seq = 0
+        self.token = None
+        # where the client's datagrams come from, None until the first one
+        self.udp_addr = None
+
+    def connection_made(self, transport):
+        global user_count
+        super().connection_made(transport)
+        self.addr = transport.get_extra_info('peername')
+        user_count += 1
+        connections.add(self)
+        if self.hello is not None:
+            self.greet(str(self.hello, FORMAT, errors='replace'))
+
+    def frame_received(self, frame):
+        if profiling.tracing:
+            started = time.perf_counter()
+            self.handle_frame(frame)
+            profiling.span('frame', started, time.perf_counter(),
+                           self.room.id if self.room is not None else 0)
+        else:
+            self.handle_frame(frame)
+
+    def handle_frame(self, frame):
+        if not self.greeted:
+            self.greet(str(frame, FORMAT, errors='replace'))
+            return
+        if self.room is None or self.spectator:
+            return
+        try:
+            buttons, seq, sent_at, acked = unpack_input(frame)
+        except struct.error:
+            self.transport.close()
+            return
+        self.input_received(buttons, seq, acked)
+
+    def greet(self, hello):
+        # 'hello' to play, 'watch' to spectate any room, 'watch <id>' for
+        # that room, 'stats' for one reply about this process's rooms
+        words = hello.split()
+        if words[:1] == ['stats'] and len(words) <= 2:
+            self.greeted = True
+            self.send_json(server_stats())
+            self.transport.close()
+        elif words == ['hello']:
+            self.greeted = True
+            lobby.append(self)
+            place_connections()
+        elif words[:1] == ['watch'] and len(words) <= 2:
+            self.greeted = True
+            self.spectator = True
+            room_id = words[1] if len(words) == 2 else None
+            watch_room(self, room_id)
+        else:
+            self.transport.close()
+
+    def latest_sent(self, tick):
+        if self.udp_addr is None:
+            self.acked = tick
+
+    def input_received(self, buttons, seq, acked):
+        # from tcp or udp, a udp input may be a copy of one we already have
+        if buttons & INPUT_DISCONNECT:
+            self.transport.close()
+            return
+        if seq <= self.last_seq:
+            return
+        self.last_seq = seq
+        if self.udp_addr is not None or acked is None:
+            # None: the client lost track, next snapshot is a keyframe
+            self.acked = acked
+        self.room.simulation.submit('input', self.slot, buttons, seq)
+
+    def connection_lost(self, exc):
+        global user_count
+        user_count -= 1
+        connections.discard(self)
+        if self.token is not None:
+            udp_tokens.pop(self.token, None)
+        if self.spectator:
+            if self.room is not None:
+                self.room.unwatch(self)
+            elif self in watchers:
+                watchers.remove(self)
+        elif self.room is not None:
+            handle_client_disconnect(self)
+        elif self in lobby:
+            lobby.remove(self)
+
+
+class UdpChannel(asyncio.DatagramProtocol):
+    # the one udp socket of this process. datagrams carry the token of their
+    # tcp connection, the first valid one tells us where to send snapshots
+
+    def connection_made(self, transport):
+        global udp
+        udp = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            token, inputs = unpack_udp_inputs(data)
+        except (ValueError, struct.error):
+            return
+        conn = udp_tokens.get(token)
+        if conn is None or conn.room is None:
+            return
+        conn.udp_addr = addr
+        conn.bytes_in += len(data)
+        conn.frames_in += 1
+        for buttons, seq, sent_at, acked in inputs:
+            conn.input_received(buttons, seq, acked)
+
+
+def new_token():
+    while True:
+        token = secrets.randbits(32)
+        if token not in udp_tokens:
+            return token
+
+
+async def start_udp(port):
+    global udp_port
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(UdpChannel, local_addr=(SERVER, port))
+    udp_port = port
+
+
+def watch_room(conn, room_id):
+    # a spectator goes straight into the room it asked for, or the oldest
+    # running one. asking for a room that isn't there closes the connection
+    if room_id is None:
+        room = min(rooms, key=lambda room: room.id, default=None)
+        if room is None:
+            watchers.append(conn)
+            return
+    else:
+        room = next((room for room in rooms if str(room.id) == room_id),
+                    None)
+        if room is None:
+            conn.send_json({"error": f"no room {room_id}"})
+            conn.transport.close()
+            return
+    room.watch(conn)
+    print(f"[SPECTATOR] {conn.addr} watching room {room.id} "
+          f"({len(room.spectators)} spectators)")
+
+
+def place_connections():
+    # pair waiting connections up: fill rooms that have a free slot first,
+    # then open new ones while we are under max_rooms
+    while lobby:
+        room = next(iter(open_rooms), None)
+        if room is None:
+            if len(rooms) >= max_rooms:
+                return
+            room = Room(tick_rate)
+            rooms.add(room)
+            open_rooms[room] = None
+            while watchers:
+                watch_room(watchers.popleft(), None)
+        conn = lobby.popleft()
+        if conn.transport.is_closing():
+            continue
+        room.join(conn)
+        if room.free_slot() is None:
+            del open_rooms[room]
+        print(f"[NEW CONNECTION] {conn.addr} joined room {room.id}. "
+              f"[ACTIVE CONNECTIONS] {user_count} [ROOMS] {len(rooms)}")
+
+
+def handle_client_disconnect(conn):
+    room = conn.room
+    room.leave(conn)
+    conn.room = None
+    print(f"[DISCONNECTED] {conn.addr} left room {room.id} "
+          f"({conn.dropped} snapshots dropped)")
+    if room.empty():
+        room.close()
+        rooms.discard(room)
+        open_rooms.pop(room, None)
+    else:
+        open_rooms[room] = None
+    place_connections()
+
+
+def server_stats():
+    # what a load test wants to know about this process: its rooms and how
+    # long their latest ticks took, in seconds
+    samples = sorted(elapsed for room in rooms
+                     for elapsed in room.simulation.tick_times)
+
+    def percentile(fraction):
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    return {
+        "rooms": len(rooms),
+        "players": sum(conn is not None for room in rooms
+                       for conn in room.players.values()),
+        "spectators": sum(len(room.spectators) for room in rooms),
+        "connections": user_count,
+        "tick_rate": tick_rate,
+        "ticks": len(samples),
+        "tick_mean": sum(samples) / len(samples) if samples else 0.0,
+        "tick_p50": percentile(0.5),
+        "tick_p99": percentile(0.99),
+        "tick_max": samples[-1] if samples else 0.0
+    }
 
-        enemies_data_str = json.dumps(enemies_data)
-        send(enemies_data_str, conn)
-        # conn.send(enemies_data_str.encode(FORMAT))
-        #print(a)
-        #print(i)
-        time2 = time.time()
 
+def collect_metrics():
+    # everything metrics.render() wants, right now
+    room_samples = []
+    for room in rooms:
+        simulation = room.simulation
+        entities = {
+            'enemies': len(simulation.enemies),
+            'lasers': sum(len(player.lasers)
+                          for player in simulation.players.values()),
+            'players': len(simulation.players),
+            'spectators': len(room.spectators)
+        }
+        room_samples.append(({
+            'room': room.id
+        }, simulation.metrics, entities))
+    connection_samples = []
+    for conn in connections:
+        if conn.room is None:
+            continue
+        labels = {
+            'room': conn.room.id,
+            'conn': f'{conn.addr[0]}:{conn.addr[1]}',
+            'role': 'spectator' if conn.spectator else 'player'
+        }
+        values = {
+            'bytes_in': conn.bytes_in,
+            'bytes_out': conn.bytes_out,
+            'frames_in': conn.frames_in,
+            'frames_out': conn.frames_out,
+            'dropped': conn.dropped
+        }
+        connection_samples.append((labels, values, conn.queue_depth()))
+    totals = {
+        'rooms': len(rooms),
+        'connections': user_count,
+        'lobby': len(lobby),
+        'timing': int(metrics.enabled)
+    }
+    return metrics.render(room_samples, connection_samples, totals)
+
+
+def serve_metrics(index=None):
+    # a task serving this process's metrics, if asked for
+    loop = asyncio.get_running_loop()
+    if metrics_port is not None:
+        port = metrics_port if index is None else metrics_port + index
+        loop.create_task(
+            metrics.serve(collect_metrics,
+                          port=port,
+                          commands=profiling.COMMANDS))
+    elif metrics_path is not None:
+        path = metrics_path if index is None else f'{metrics_path}.{index}'
+        if os.path.exists(path):
+            os.unlink(path)
+        loop.create_task(
+            metrics.serve(collect_metrics,
+                          path=path,
+                          commands=profiling.COMMANDS))
+
+
+async def report_backpressure():
+    # every so often, the connections that couldn't keep up with the
+    # snapshot stream since the last report
+    reported = {}
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
+        for conn in list(connections):
+            if conn.dropped != reported.get(conn, 0):
+                print(f"[BACKPRESSURE] {conn.addr} queue depth "
+                      f"{conn.queue_depth()}, "
+                      f"{conn.transport.get_write_buffer_size()} bytes "
+                      f"buffered, {conn.dropped} snapshots dropped")
+        reported = {conn: conn.dropped for conn in connections}
+
+
+def raise_file_limit():
+    # every connection is a file descriptor, allow as many as we may
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def start():
+    raise_file_limit()
+    loop = asyncio.get_running_loop()
+    if use_udp:
+        await start_udp(PORT)
+    loop.create_task(report_backpressure())
+    serve_metrics()
+    profiling.install_signals()
+    server = await loop.create_server(Connection, SERVER, PORT, backlog=1024)
+    print(f"[LISTENING] server is listening on {SERVER} "
+          f"({tick_rate} Hz, up to {max_rooms} rooms)")
+    async with server:
+        await server.serve_forever()
+
+
+# multi-process mode: a front process accepts every connection and hands the
+# socket over (SCM_RIGHTS) to one of the worker processes, each running its
+# own event loop with its own rooms. workers tell the front how loaded they
+# are, so new rooms go to the least busy one.
+#
+# the front reads each connection's hello itself, so spectators go to the
+# worker running the room they watch, and passes it on with the socket.
+#
+# worker -> front status: rooms, rooms with a free slot, fraction of the last
+# interval spent ticking
+STATUS = struct.Struct('!IIf')
+STATUS_INTERVAL = 0.5
+# what the front guesses one more room costs, until the next status tells
+ROOM_LOAD = 0.005
+# longest hello the front accepts, and how long it waits for one
+MAX_HELLO = 64
+HELLO_TIMEOUT = 10
+
+
+class Worker:
+    # the front's view of one worker process
+
+    def __init__(self, index, count, siblings):
+        self.index = index
+        self.control, child = socket.socketpair(socket.AF_UNIX,
+                                                socket.SOCK_SEQPACKET)
+        # the front's ends the worker inherits and has to close, or it never
+        # sees its own control socket hang up when the front goes away
+        inherited = [self.control] + [worker.control for worker in siblings]
+        self.process = multiprocessing.Process(target=worker_main,
+                                               args=(index, count, child,
+                                                     inherited,
+                                                     tick_rate, max_rooms,
+                                                     simulation_class,
+                                                     use_udp, spectator_rate,
+                                                     view_margin,
+                                                     record_dir, PORT,
+                                                     metrics_port,
+                                                     metrics_path,
+                                                     profiling.profile_dir),
+                                               daemon=True)
+        self.process.start()
+        child.close()
+        self.rooms = 0
+        self.open_rooms = 0
+        self.load = 0.0
+
+    def read_status(self):
+        try:
+            msg = self.control.recv(STATUS.size)
+        except BlockingIOError:
+            return
+        if len(msg) == STATUS.size:
+            self.rooms, self.open_rooms, self.load = STATUS.unpack(msg)
+
+    def hand_over(self, conn, hello):
+        socket.send_fds(self.control, [hello], [conn.fileno()])
+        if hello != b'hello':
+            return
+        # guess what this does to the worker until it reports back
+        if self.open_rooms > 0:
+            self.open_rooms -= 1
+        else:
+            self.load += self.load / self.rooms if self.rooms else ROOM_LOAD
+            self.rooms += 1
+            self.open_rooms += 1
+
+
+def pick_worker(workers, hello):
+    # a spectator goes where its room is: room ids are handed out so that
+    # worker i runs rooms i + 1, i + 1 + count, ... and any room will do
+    # for a plain 'watch'. 'stats <i>' asks worker i
+    words = hello.split()
+    if words[:1] == [b'stats']:
+        if len(words) == 2 and words[1].isdigit():
+            return workers[int(words[1]) % len(workers)]
+        return workers[0]
+    if words[:1] == [b'watch']:
+        if len(words) == 2 and words[1].isdigit():
+            return workers[(int(words[1]) - 1) % len(workers)]
+        return max(workers, key=lambda worker: worker.rooms)
+    # a room waiting for its second player comes first, so both players of a
+    # match end up in the same process, otherwise the least loaded one
+    waiting = [worker for worker in workers if worker.open_rooms > 0]
+    return min(waiting or workers, key=lambda worker: worker.load)
+
+
+async def start_front(count):
+    raise_file_limit()
+    loop = asyncio.get_running_loop()
+    workers = []
+    for index in range(count):
+        workers.append(Worker(index, count, workers))
+    for worker in workers:
+        worker.control.setblocking(False)
+        loop.add_reader(worker.control, worker.read_status)
+    profiling.forward_signals([worker.process.pid for worker in workers])
+
+    listener = socket.create_server(ADDR, backlog=1024)
+    listener.setblocking(False)
+    print(f"[LISTENING] server is listening on {SERVER} "
+          f"({tick_rate} Hz, {count} workers, up to {max_rooms} rooms each)")
+    while True:
+        conn, addr = await loop.sock_accept(listener)
+        loop.create_task(route_connection(workers, conn, addr))
 
-def start():
-    global user_count
-    global semaphore4
 
-    server.listen()
-    print(f"[LISTENING] server is listening on {SERVER}")
+async def read_hello(conn):
+    # the first frame of a new connection, None if it isn't a short one. the
+    # client waits for the reply to it, so nothing else can be buffered yet
+    loop = asyncio.get_running_loop()
+    data = b''
     while True:
-        if user_count < 2:
-            conn, addr = server.accept()
-            if (data["user1"] == '0.0.0.0'):
-                data["user1"] = addr
-            elif (data["user2"] == '0.0.0.0'):
-                data["user2"] = addr
-            with semaphore4:
-                user_count += 1
-            thread = threading.Thread(target=handle_client, args=(conn, addr))
-            thread.start()
-            #thread.join()
-            print(f"[ACTIVE CONNECTIONS]{threading.activeCount()- 1}")
-        else:
-            pass
+        if len(data) >= HEADER.size:
+            (length, ) = HEADER.unpack_from(data)
+            if length > MAX_HELLO:
+                return None
+            if len(data) >= HEADER.size + length:
+                return data[HEADER.size:HEADER.size + length]
+        chunk = await loop.sock_recv(conn, 256)
+        if not chunk:
+            return None
+        data += chunk
+
+
+async def route_connection(workers, conn, addr):
+    try:
+        hello = await asyncio.wait_for(read_hello(conn), HELLO_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        hello = None
+    if hello is not None:
+        worker = pick_worker(workers, hello)
+        try:
+            worker.hand_over(conn, hello)
+        except OSError:
+            print(f"[WORKER {worker.index}] could not take {addr}")
+    conn.close()
+
+
+def worker_main(index, count, control, inherited, worker_tick_rate,
+                worker_max_rooms, worker_simulation_class, worker_use_udp,
+                worker_spectator_rate, worker_view_margin, worker_record_dir,
+                worker_port, worker_metrics_port, worker_metrics_path,
+                worker_profile_dir):
+    global tick_rate, max_rooms, simulation_class, use_udp, spectator_rate
+    global view_margin, record_dir, PORT, metrics_port, metrics_path
+    for sock in inherited:
+        sock.close()
+    tick_rate = worker_tick_rate
+    max_rooms = worker_max_rooms
+    simulation_class = worker_simulation_class
+    use_udp = worker_use_udp
+    spectator_rate = worker_spectator_rate
+    view_margin = worker_view_margin
+    record_dir = worker_record_dir
+    PORT = worker_port
+    metrics_port = worker_metrics_port
+    metrics_path = worker_metrics_path
+    profiling.profile_dir = worker_profile_dir
+    # keep room ids unique across workers
+    Room.ids = itertools.count(index + 1, count)
+    asyncio.run(run_worker(index, control))
+
+
+async def run_worker(index, control):
+    loop = asyncio.get_running_loop()
+    control.setblocking(False)
+    if use_udp:
+        # the front only passes tcp sockets on, each worker gets a udp port
+        # of its own and hands it out in the join reply
+        await start_udp(PORT + 1 + index)
+    loop.create_task(report_backpressure())
+    serve_metrics(index)
+    profiling.install_signals()
+    closed = loop.create_future()
+    front = os.getppid()
+
+    def receive_connections():
+        while True:
+            try:
+                msg, fds, flags, addr = socket.recv_fds(
+                    control, MAX_HELLO, 16)
+            except BlockingIOError:
+                return
+            if not msg and not fds:
+                # the front process is gone
+                if not closed.done():
+                    closed.set_result(None)
+                return
+            for fd in fds:
+                sock = socket.socket(fileno=fd)
+                loop.create_task(
+                    loop.connect_accepted_socket(
+                        functools.partial(Connection, msg), sock))
+
+    loop.add_reader(control, receive_connections)
+    print(f"[WORKER {index}] started")
+    while not closed.done():
+        await asyncio.wait([closed], timeout=STATUS_INTERVAL)
+        if os.getppid() != front:
+            # killed without a chance to hang up
+            break
+        busy = 0.0
+        for room in rooms:
+            busy += room.simulation.busy
+            room.simulation.busy = 0.0
+        try:
+            control.send(
+                STATUS.pack(len(rooms), len(open_rooms),
+                            busy / STATUS_INTERVAL))
+        except OSError:
+            break
+    # nobody can reach this worker any more, end its matches the way the
+    # players leaving them would
+    print(f"[WORKER {index}] front is gone, closing {len(rooms)} rooms")
+    for conn in list(connections):
+        conn.transport.abort()
+    await asyncio.sleep(0)
+    for room in list(rooms):
+        room.close()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port',
+                        type=int,
+                        default=PORT,
+                        help="tcp port to listen on (udp: the same, workers "
+                        "the ones after it)")
+    parser.add_argument('--tick-rate',
+                        type=int,
+                        default=TICK_RATE,
+                        help="simulation ticks per second (e.g. 30, 60, 120)")
+    parser.add_argument('--max-rooms',
+                        type=int,
+                        default=MAX_ROOMS,
+                        help="matches hosted at once, the rest wait in the lobby")
+    parser.add_argument('--workers',
+                        type=int,
+                        default=WORKERS,
+                        help="worker processes running the rooms, 0 runs "
+                        "everything in this process")
+    parser.add_argument('--arrays',
+                        action='store_true',
+                        help="keep enemies in numpy arrays, for very large "
+                        "waves (needs numpy)")
+    parser.add_argument('--udp',
+                        action='store_true',
+                        help="offer clients snapshots and inputs over udp, "
+                        "on the same port (workers: port + 1 + index)")
+    parser.add_argument('--spectator-rate',
+                        type=float,
+                        help="snapshots per second for spectators, every "
+                        "tick by default")
+    parser.add_argument('--view-margin',
+                        type=int,
+                        default=VIEW_MARGIN,
+                        help="pixels around the screen whose enemies are "
+                        "sent, the ones further out are left out of snapshots")
+    parser.add_argument('--record',
+                        metavar='DIR',
+                        help="record every match to DIR, for replay.py")
+    parser.add_argument('--metrics',
+                        type=int,
+                        metavar='PORT',
+                        help="serve prometheus metrics on localhost:PORT "
+                        "(workers: PORT + index)")
+    parser.add_argument('--metrics-socket',
+                        metavar='PATH',
+                        help="serve them on a unix socket instead (workers: "
+                        "PATH.index)")
+    parser.add_argument('--profile-dir',
+                        default=profiling.profile_dir,
+                        help="where profiles, memory snapshots and traces "
+                        "are written")
+    args = parser.parse_args()
+    PORT = args.port
+    metrics_port = args.metrics
+    metrics_path = args.metrics_socket
+    profiling.profile_dir = args.profile_dir
+    ADDR = (SERVER, PORT)
+    tick_rate = args.tick_rate
+    spectator_rate = args.spectator_rate
+    if spectator_rate is not None and spectator_rate <= 0:
+        parser.error("--spectator-rate must be positive")
+    if not 0 <= args.view_margin <= 65535:
+        parser.error("--view-margin must be between 0 and 65535")
+    view_margin = args.view_margin
+    if args.record is not None:
+        os.makedirs(args.record, exist_ok=True)
+        record_dir = args.record
+    max_rooms = args.max_rooms
+    use_udp = args.udp
+    if args.arrays:
+        if ArraySimulation is None:
+            parser.error("--arrays needs numpy (pip install numpy)")
+        simulation_class = ArraySimulation
     print("[STARTING] server is starting...")
-    start()
+    if args.workers > 0:
+        asyncio.run(start_front(args.workers))
+    else:
+        asyncio.run(start())
@@ -0,0 +1,615 @@
+import time
+import random
+import asyncio
+import itertools
+import collections
+
+import metrics
+import profiling
+import snapshots
+from sprites import load_sprites
+from collision import SpatialHash, collide
+from protocol import encode_json, INPUT_FIRE, INPUT_READY
+from rules import (WIDTH, HEIGHT, PLAYER_SPEED, ENEMY_SPEED, LASER_SPEED,
+                   COOLDOWN_TIME, per_tick, move_player)
+
+# sizes and collision masks of every image, built once for the whole process
+SPRITES = load_sprites()
+
+# spawn positions of the two player slots
+SPAWN = {1: (220, 630), 2: (400, 630)}
+NO_USER = '0.0.0.0'
+# pixels around the screen whose entities are still sent to clients. waves
+# spawn far above the screen, only the ones about to come into view go out
+VIEW_MARGIN = 100
+
+# every enemy and laser gets an id that stays the same for its whole life, so
+# snapshots can be sent as deltas
+entity_ids = itertools.count(1)
+
+
+class Pool:
+    # free list of entities that are done, so a new laser or enemy reuses an
+    # old object instead of allocating one. acquire() takes the same
+    # arguments as the class and calls reset() on a recycled object. every
+    # room in the process shares the pools, the event loop runs one at a time
+
+    def __init__(self, cls, limit=10000):
+        self.cls = cls
+        self.limit = limit
+        self.free = []
+
+    def acquire(self, *args):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args)
+            return obj
+        return self.cls(*args)
+
+    def release(self, obj):
+        if len(self.free) < self.limit:
+            self.free.append(obj)
+
+    def release_all(self, objs):
+        for obj in objs:
+            self.release(obj)
+
+
+class Laser:
+    __slots__ = ('id', 'x', 'y', 'sprite', 'mask')
+
+    def __init__(self, x, y, sprite):
+        self.reset(x, y, sprite)
+
+    def reset(self, x, y, sprite):
+        self.id = next(entity_ids)
+        self.x = x
+        self.y = y
+        self.sprite = sprite
+        self.mask = sprite.mask
+
+    def move(self, vel):
+        self.y += vel
+
+    def off_screen(self, height):
+        return not (self.y <= height and self.y >= 0)
+
+    def collision(self, obj):
+        return collide(self, obj)
+
+
+class Ship:
+    __slots__ = ('x', 'y', 'health', 'sprite', 'laser_sprite', 'mask',
+                 'lasers', 'cool_down_counter', 'cooldown_ticks')
+    COOLDOWN = 20
+
+    def __init__(self, x, y, health=100):
+        self.x = x
+        self.y = y
+        self.health = health
+        self.sprite = None
+        self.laser_sprite = None
+        self.mask = None
+        self.lasers = []
+        self.cool_down_counter = 0
+        self.cooldown_ticks = self.COOLDOWN
+
+    def cooldown(self):
+        if self.cool_down_counter >= self.cooldown_ticks:
+            self.cool_down_counter = 0
+        elif self.cool_down_counter > 0:
+            self.cool_down_counter += 1
+
+    def shoot(self):
+        if self.cool_down_counter == 0:
+            laser = LASERS.acquire(self.x, self.y, self.laser_sprite)
+            self.lasers.append(laser)
+            self.cool_down_counter = 1
+
+    def get_width(self):
+        return self.sprite.width
+
+    def get_height(self):
+        return self.sprite.height
+
+
+class Player(Ship):
+    __slots__ = ('max_health',)
+
+    def __init__(
+        self,
+        x,
+        y,
+        health=100,
+    ):
+        super().__init__(
+            x,
+            y,
+            health,
+        )
+        self.sprite = SPRITES['ship_yellow']
+        self.laser_sprite = SPRITES['laser_yellow']
+        self.mask = self.sprite.mask
+        self.max_health = health
+
+
+class Enemy(Ship):
+    __slots__ = ('id', 'color')
+    COLOR_MAP = {
+        "red": (SPRITES['ship_red'], SPRITES['laser_red']),
+        "green": (SPRITES['ship_green'], SPRITES['laser_green']),
+        "blue": (SPRITES['ship_blue'], SPRITES['laser_blue'])
+    }
+
+    def __init__(self, x, y, color, health=100):
+        super().__init__(x, y, health)
+        self.reset(x, y, color, health)
+
+    def reset(self, x, y, color, health=100):
+        self.id = next(entity_ids)
+        self.x = x
+        self.y = y
+        self.health = health
+        self.color = color
+        self.sprite, self.laser_sprite = self.COLOR_MAP[color]
+        self.mask = self.sprite.mask
+        self.lasers.clear()
+        self.cool_down_counter = 0
+
+    def move(self, vel):
+        self.y += vel
+
+    def shoot(self):
+        if self.cool_down_counter == 0:
+            laser = LASERS.acquire(self.x - 20, self.y, self.laser_sprite)
+            self.lasers.append(laser)
+            self.cool_down_counter = 1
+
+
+LASERS = Pool(Laser)
+ENEMIES = Pool(Enemy)
+
+
+def new_data():
+    return {
+        'ready': False,
+        'level': 0,
+        'user1': NO_USER,
+        'user2': NO_USER,
+        'x1': 0,
+        'y1': 0,
+        'health1': 100,
+        'lost1': False,
+        'seq1': 0,
+        'x2': 0,
+        'y2': 0,
+        'health2': 100,
+        'lost2': False,
+        'seq2': 0,
+        'win1': False,
+        'win2': False
+    }
+
+
+class Simulation:
+    # the one authoritative copy of the world. it is only ever changed by
+    # step(), connections talk to it through submit() (joins, inputs, leaves)
+    # and get their snapshots from snapshot_frame() when a tick is published
+
+    # how many ticks of world states are kept as delta baselines
+    HISTORY = 64
+    # when the loop falls this far behind it stops trying to catch up
+    MAX_LAG = 0.25
+    # inputs queued per player before the oldest are dropped
+    MAX_INPUTS = 8
+    # how many of the latest step() durations are kept for stats
+    TICK_SAMPLES = 256
+
+    def __init__(self, tick_rate=60, seed=None, view_margin=VIEW_MARGIN):
+        self.tick_rate = tick_rate
+        self.dt = 1.0 / tick_rate
+        # waves come from this generator only, so a seed and the inputs of
+        # every tick are enough to play a match again
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.seed = seed
+        self.random = random.Random(seed)
+        # pixels enemies and lasers move this tick, see rules.per_tick()
+        self.enemy_vel = 0
+        self.laser_vel = 0
+        self.cooldown_ticks = max(1, round(COOLDOWN_TIME * tick_rate))
+        # the screen grown by view_margin on every side, (left, top, right,
+        # bottom): snapshots only hold the entities overlapping it
+        self.view_margin = view_margin
+        self.view = (-view_margin, -view_margin, WIDTH + view_margin,
+                     HEIGHT + view_margin)
+
+        self.data = new_data()
+        self.players = {}
+        # inputs not applied yet, per slot, and the buttons of this tick
+        self.inputs = {}
+        self.buttons = {}
+        self.enemies = self.new_enemies()
+        self.grid = SpatialHash()
+        self.level = 0
+        self.wave_length = 10
+        self.tick = 0
+        self.running = False
+        # seconds spent in step() since someone last reset it, and how long
+        # the latest steps took
+        self.busy = 0.0
+        self.tick_times = collections.deque(maxlen=self.TICK_SAMPLES)
+
+        self.commands = collections.deque()
+        self.wake = None
+        # called with the simulation after every tick
+        self.listeners = []
+        self.history = {}
+        self.delta_cache = {}
+        # a replay.Recorder writing this match down, or None
+        self.recorder = None
+        # a metrics.TickMetrics the tick phases go to while metrics are
+        # read, timing says whether this tick is timed (for metrics or for
+        # trace spans, which show up under the room's id)
+        self.metrics = None
+        self.room = 0
+        self.timing = False
+        self.encode_time = 0.0
+        self.state = self.capture_state()
+
+    def new_enemies(self):
+        return []
+
+    def submit(self, *command):
+        # ('join', slot, addr), ('input', slot, buttons, seq), ('leave', slot)
+        self.commands.append(command)
+        if self.wake is not None:
+            self.wake.set()
+
+    def process_commands(self):
+        while self.commands:
+            command = self.commands.popleft()
+            kind, slot = command[0], command[1]
+            if kind == 'join':
+                self.data[f'user{slot}'] = command[2]
+                self.spawn_player(slot)
+            elif kind == 'input':
+                queue = self.inputs.get(slot)
+                if queue is None:
+                    queue = self.inputs[slot] = collections.deque()
+                queue.append((command[2], command[3]))
+            elif kind == 'leave':
+                self.remove_player(slot)
+            if kind != 'input' and self.recorder is not None:
+                self.recorder.command(kind, slot)
+        self.next_inputs()
+
+    def next_inputs(self):
+        # every input is applied for exactly one tick, in order, so a client
+        # that runs the same movement rules knows where its ship is. the
+        # seq of the last applied one goes out in the snapshot for the
+        # client to drop what the server has seen. without a new input the
+        # ship stays put, only ready carries over
+        data = self.data
+        for slot in self.players:
+            queue = self.inputs.get(slot)
+            if queue:
+                while len(queue) > self.MAX_INPUTS:
+                    queue.popleft()
+                self.buttons[slot], data[f'seq{slot}'] = queue.popleft()
+            else:
+                self.buttons[slot] = self.buttons.get(slot, 0) & INPUT_READY
+
+    def spawn_player(self, slot):
+        old = self.players.get(slot)
+        if old is not None:
+            LASERS.release_all(old.lasers)
+        player = Player(*SPAWN[slot])
+        player.cooldown_ticks = self.cooldown_ticks
+        self.players[slot] = player
+        return player
+
+    def remove_player(self, slot):
+        data = self.data
+        data['win1'] = False
+        data['win2'] = False
+        self.level = 0
+        self.wave_length = 10
+        data['lost1'] = False
+        data['lost2'] = False
+        self.clear_enemies()
+        player = self.players.pop(slot, None)
+        if player is not None:
+            LASERS.release_all(player.lasers)
+        self.buttons.pop(slot, None)
+        self.inputs.pop(slot, None)
+        data[f'seq{slot}'] = 0
+        data[f'user{slot}'] = NO_USER
+        data[f'health{slot}'] = 100
+
+    def step(self):
+        timing = self.timing = ((self.metrics is not None and metrics.enabled)
+                               or profiling.tracing)
+        if timing:
+            started = time.perf_counter()
+        self.process_commands()
+        if timing:
+            commands_done = time.perf_counter()
+        data = self.data
+
+        both_ready = all(
+            self.buttons.get(slot, 0) & INPUT_READY for slot in SPAWN)
+        if both_ready:
+            if not data['ready']:
+                self.clear_enemies()
+                for slot in list(self.players):
+                    self.spawn_player(slot)
+            data['ready'] = True
+            data['lost1'] = False
+            data['lost2'] = False
+            data['win1'] = False
+            data['win2'] = False
+
+        playing = False
+        if not data['ready']:
+            self.level = 0
+            self.wave_length = 10
+            data['lost1'] = False
+            data['lost2'] = False
+        elif data['user1'] == NO_USER or data['user2'] == NO_USER or data[
+                'lost1'] or data['lost2']:
+            # reset everything in case of lost of one of the player
+            data['lost1'] = False
+            data['lost2'] = False
+            data['ready'] = False
+            self.level = 0
+            self.wave_length = 10
+            for slot in list(self.players):
+                self.spawn_player(slot)
+        else:
+            playing = True
+
+        for slot, player in self.players.items():
+            if player.health <= 0:
+                data[f'lost{slot}'] = True
+                data[f'win{3 - slot}'] = True
+
+        if len(self.enemies) == 0:
+            self.spawn_wave()
+
+        # a ship moves by the number of the input it applies, the client
+        # predicting it knows that number too
+        for slot, player in self.players.items():
+            if playing:
+                player_vel = per_tick(PLAYER_SPEED, self.tick_rate,
+                                      data[f'seq{slot}'])
+            else:
+                player_vel = 0
+            self.move_player(player, self.buttons.get(slot, 0), player_vel)
+
+        self.enemy_vel = per_tick(ENEMY_SPEED, self.tick_rate, self.tick + 1)
+        self.laser_vel = per_tick(LASER_SPEED, self.tick_rate, self.tick + 1)
+        if playing:
+            self.move_enemies()
+        if timing:
+            collision_started = time.perf_counter()
+        self.resolve_collisions()
+        if timing:
+            collision_done = time.perf_counter()
+
+        data['level'] = self.level
+        for slot, player in self.players.items():
+            data[f'x{slot}'] = player.x
+            data[f'y{slot}'] = player.y
+            data[f'health{slot}'] = player.health
+
+        self.tick += 1
+        if timing:
+            self.encode_time = 0.0
+            publish_started = time.perf_counter()
+            captured = self.publish()
+            ended = time.perf_counter()
+            if self.metrics is not None and metrics.enabled:
+                self.metrics.record(
+                    ended - started,
+                    (commands_done - started,
+                     (collision_started - commands_done) +
+                     (publish_started - collision_done),
+                     collision_done - collision_started,
+                     (captured - publish_started) + self.encode_time,
+                     ended - captured - self.encode_time))
+            if profiling.tracing:
+                self.trace((('tick', started, ended),
+                            ('input', started, commands_done),
+                            ('simulation', commands_done, collision_started),
+                            ('collision', collision_started, collision_done),
+                            ('simulation', collision_done, publish_started),
+                            ('capture', publish_started, captured),
+                            ('send', captured, ended)))
+        else:
+            self.publish()
+        if self.recorder is not None:
+            self.recorder.stepped(self)
+
+    def trace(self, spans):
+        for name, started, ended in spans:
+            profiling.span(name, started, ended, self.room, tick=self.tick)
+
+    def spawn_wave(self):
+        self.level += 1
+        self.wave_length += 10
+        rng = self.random
+        for i in range(self.wave_length):
+            enemy = ENEMIES.acquire(rng.randrange(50, WIDTH - 100),
+                                    rng.randrange(-1500, -100),
+                                    rng.choice(["red", "blue", "green"]))
+            self.enemies.append(enemy)
+
+    def move_player(self, player, buttons, vel):
+        player.x, player.y = move_player(player.x, player.y, buttons, vel,
+                                         player.get_width(),
+                                         player.get_height())
+        if buttons & INPUT_FIRE:
+            player.shoot()
+
+    def move_enemies(self):
+        vel = self.enemy_vel
+        kept = []
+        for enemy in self.enemies:
+            enemy.move(vel)
+            if enemy.y + enemy.get_height() <= HEIGHT:
+                kept.append(enemy)
+            else:
+                ENEMIES.release(enemy)
+        self.enemies = kept
+
+    def resolve_collisions(self):
+        # the enemies are indexed once per tick, then the players and every
+        # laser ask the index what they touch
+        self.index_enemies()
+        dead = set()
+        for player in self.players.values():
+            for enemy in self.enemy_hits(player):
+                if enemy not in dead:
+                    dead.add(enemy)
+                    player.health -= 10
+
+        for player in self.players.values():
+            player.cooldown()
+            for laser in player.lasers:
+                laser.move(-self.laser_vel)
+            kept = []
+            for laser in player.lasers:
+                if laser.off_screen(HEIGHT):
+                    LASERS.release(laser)
+                    continue
+                hits = [
+                    enemy for enemy in self.enemy_hits(laser)
+                    if enemy not in dead
+                ]
+                if hits:
+                    dead.update(hits)
+                    LASERS.release(laser)
+                else:
+                    kept.append(laser)
+            player.lasers = kept
+
+        if dead:
+            self.remove_enemies(dead)
+
+    def index_enemies(self):
+        self.grid.build(self.enemies)
+
+    def enemy_hits(self, obj):
+        # the enemies obj touches
+        return self.grid.collisions(obj)
+
+    def remove_enemies(self, dead):
+        self.enemies = [enemy for enemy in self.enemies if enemy not in dead]
+        ENEMIES.release_all(dead)
+
+    def clear_enemies(self):
+        ENEMIES.release_all(self.enemies)
+        self.enemies.clear()
+
+    async def run(self):
+        # fixed timestep: every step advances the world by exactly dt, and
+        # the loop sleeps until the next tick is due
+        loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.running = True
+        next_tick = loop.time()
+        while self.running:
+            if not self.players and not self.commands:
+                # nobody is playing, sleep until someone joins
+                self.wake.clear()
+                await self.wake.wait()
+                next_tick = loop.time()
+                continue
+            started = loop.time()
+            self.step()
+            elapsed = loop.time() - started
+            self.busy += elapsed
+            self.tick_times.append(elapsed)
+            next_tick += self.dt
+            delay = next_tick - loop.time()
+            if delay < -self.MAX_LAG:
+                next_tick = loop.time()
+            await asyncio.sleep(max(delay, 0))
+
+    def stop(self):
+        self.running = False
+        if self.wake is not None:
+            self.wake.set()
+
+    def capture_state(self):
+        # lasers live between the top and the bottom of the screen, only
+        # enemies can be out of view
+        enemies, hidden = self.enemy_states()
+        state = {
+            'tick': self.tick,
+            'data': dict(self.data),
+            'enemies': enemies,
+            'hidden': {
+                'enemies': hidden
+            }
+        }
+        for slot in SPAWN:
+            player = self.players.get(slot)
+            lasers = player.lasers if player is not None else []
+            state[f'lasers{slot}'] = {
+                laser.id: {
+                    'x': laser.x,
+                    'y': laser.y
+                }
+                for laser in lasers
+            }
+        return state
+
+    def enemy_states(self):
+        # the enemies in view, and the ids of the ones out of it
+        left, top, right, bottom = self.view
+        states = {}
+        hidden = set()
+        for enemy in self.enemies:
+            x = enemy.x
+            y = enemy.y
+            sprite = enemy.sprite
+            if (x < right and y < bottom and x + sprite.width > left
+                    and y + sprite.height > top):
+                states[enemy.id] = {'ex': x, 'ey': y, 'ecolor': enemy.color}
+            else:
+                hidden.add(enemy.id)
+        return states, hidden
+
+    def publish(self):
+        # returns when the state was captured, if this tick is timed
+        state = self.capture_state()
+        self.state = state
+        self.history[state['tick']] = state
+        self.history.pop(state['tick'] - self.HISTORY, None)
+        self.delta_cache.clear()
+        captured = time.perf_counter() if self.timing else None
+        for listener in self.listeners:
+            listener(self)
+        return captured
+
+    def delta(self, base, state):
+        return snapshots.delta(base, state)
+
+    def snapshot_frame(self, acked):
+        # a delta frame is encoded once per baseline, so clients that acked
+        # the same tick share the same bytes. acked is None on join or when
+        # the client asks for a keyframe
+        base = self.history.get(acked)
+        if base is None:
+            base = snapshots.new_state()
+        frame = self.delta_cache.get(base['tick'])
+        if frame is None:
+            if self.timing:
+                started = time.perf_counter()
+            frame = encode_json(self.delta(base, self.state))
+            self.delta_cache[base['tick']] = frame
+            if self.timing:
+                self.encode_time += time.perf_counter() - started
+        return frame
@@ -0,0 +1,123 @@
+# delta compression of world snapshots
+#
+# a world state is
+#   {'tick': int, 'data': {...},
+#    'enemies': {id: {'ex', 'ey', 'ecolor'}},
+#    'lasers1': {id: {'x', 'y'}}, 'lasers2': {id: {'x', 'y'}}}
+#
+# the server sends each client only what changed since the last tick that
+# client acknowledged ('base'). a snapshot with 'base' None is a keyframe and
+# holds the whole world.
+#
+# only entities near the screen are in a state. on the server a state also
+# has 'hidden': {kind: ids of entities that exist but are out of view}, so
+# an entity coming into view is sent as 'enter' rather than 'spawn' and one
+# going out of view as 'leave' rather than 'despawn'. clients apply them
+# the same way, the difference only says whether it is new or gone for good
+#
+# an entry may also have 'move': {field: amount}, added to that field of
+# every entity the client keeps from the base. the numpy enemies send a
+# whole wave moving down together that way instead of one update each
+
+ENTITY_KINDS = ('enemies', 'lasers1', 'lasers2')
+
+
+def new_state():
+    state = {'tick': None, 'data': {}}
+    for kind in ENTITY_KINDS:
+        state[kind] = {}
+    return state
+
+
+def changed_fields(old, new):
+    return {key: value for key, value in new.items() if old.get(key) != value}
+
+
+def delta(base, state, kinds=ENTITY_KINDS):
+    msg = {
+        'tick': state['tick'],
+        'base': base['tick'],
+        'data': changed_fields(base['data'], state['data'])
+    }
+    hidden_before = base.get('hidden', {})
+    hidden_now = state.get('hidden', {})
+    for kind in kinds:
+        old = base[kind]
+        new = state[kind]
+        was_hidden = hidden_before.get(kind, ())
+        spawn = {}
+        enter = {}
+        update = {}
+        for eid, fields in new.items():
+            before = old.get(eid)
+            if before is None:
+                if eid in was_hidden:
+                    enter[eid] = fields
+                else:
+                    spawn[eid] = fields
+            elif before != fields:
+                update[eid] = changed_fields(before, fields)
+        despawn = []
+        leave = []
+        if len(old) > len(new) - len(spawn) - len(enter):
+            is_hidden = hidden_now.get(kind, ())
+            for eid in old:
+                if eid not in new:
+                    if eid in is_hidden:
+                        leave.append(eid)
+                    else:
+                        despawn.append(eid)
+
+        entry = {}
+        if spawn:
+            entry['spawn'] = spawn
+        if enter:
+            entry['enter'] = enter
+        if update:
+            entry['update'] = update
+        if despawn:
+            entry['despawn'] = despawn
+        if leave:
+            entry['leave'] = leave
+        if entry:
+            msg[kind] = entry
+    return msg
+
+
+def apply(state, msg):
+    # works on decoded json, so entity ids are the string keys of the dicts.
+    # an updated entity gets a new fields dict instead of being changed in
+    # place, so a copy_state() copy taken earlier never changes under you
+    if msg['base'] is None:
+        state = new_state()
+    state['tick'] = msg['tick']
+    state['data'].update(msg['data'])
+    for kind in ENTITY_KINDS:
+        entry = msg.get(kind)
+        if entry is None:
+            continue
+        entities = state[kind]
+        for eid in entry.get('despawn', ()):
+            entities.pop(str(eid), None)
+        for eid in entry.get('leave', ()):
+            entities.pop(str(eid), None)
+        move = entry.get('move')
+        if move:
+            for eid, fields in entities.items():
+                moved = dict(fields)
+                for key, amount in move.items():
+                    moved[key] += amount
+                entities[eid] = moved
+        entities.update(entry.get('spawn', {}))
+        entities.update(entry.get('enter', {}))
+        for eid, fields in entry.get('update', {}).items():
+            entities[eid] = {**entities[eid], **fields}
+    return state
+
+
+def copy_state(state):
+    # a copy apply() won't touch, cheap enough to take after every snapshot
+    copy = {'tick': state['tick'], 'data': dict(state['data'])}
+    for kind in ENTITY_KINDS:
+        copy[kind] = dict(state[kind])
+    return copy
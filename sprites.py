@@ -0,0 +1,41 @@
+import os
+
+import pygame
+
+ASSETS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+
+SPRITE_FILES = {
+    'ship_red': "pixel_ship_red_small.png",
+    'ship_green': "pixel_ship_green_small.png",
+    'ship_blue': "pixel_ship_blue_small.png",
+    'ship_yellow': "pixel_ship_yellow.png",
+    'laser_red': "pixel_laser_red.png",
+    'laser_green': "pixel_laser_green.png",
+    'laser_blue': "pixel_laser_blue.png",
+    'laser_yellow': "pixel_laser_yellow.png",
+}
+
+
+class Sprite:
+    # what the server needs to know about an image: its size, its collision
+    # mask and the box around its opaque pixels. built once and shared by
+    # every entity that uses it, the image itself is not kept
+
+    def __init__(self, name, surface):
+        self.name = name
+        self.width, self.height = surface.get_size()
+        self.mask = pygame.mask.from_surface(surface)
+        rects = self.mask.get_bounding_rects()
+        if rects:
+            rect = rects[0].unionall(rects[1:])
+            self.bounds = (rect.x, rect.y, rect.width, rect.height)
+        else:
+            self.bounds = (0, 0, 0, 0)
+
+
+def load_sprites(directory=ASSETS):
+    # no display needed: images are only loaded, never converted or drawn
+    return {
+        name: Sprite(name, pygame.image.load(os.path.join(directory, file)))
+        for name, file in SPRITE_FILES.items()
+    }